@@ -0,0 +1,118 @@
+import asyncio
+import heapq
+import itertools
+import math
+from typing import TYPE_CHECKING
+
+from api_keys import KEY_WEIGHTS
+from metrics import Gauge
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional, Tuple, Union
+
+# this module decides when a new lookup may start. Lookups cost the website and the API, and there are only so many
+# clients, so only a few of them run at a time. The others wait in line, and the api keys take turns, so one key sending
+# a lot of usernames at once doesn't hold up everyone else. Requests which are answered from the cache, or wait for a
+# lookup which is running anyway, don't get in line
+
+# this many lookups run at the same time for every client which isn't in a flood wait. Telethon sends them all over the
+# one connection of the client, so this is about how many we want to have waiting for telegram at once
+LOOKUPS_PER_CLIENT = 25
+# this many can wait in line. If it is full, new ones are turned away with a 429
+QUEUE_LIMIT = 1000
+# and a lookup which would likely wait longer than this many seconds is turned away right away as well
+MAX_WAIT = 5.0
+# how long a lookup takes until we know better. Every finished lookup moves the estimate by SMOOTHING towards its time
+SERVICE_TIME = 0.5
+SMOOTHING = 0.05
+
+
+class AdmissionQueue:
+    """
+    This hands out the slots for the lookups. If there is a free one and nobody waits, a lookup starts right away.
+    Otherwise it waits, and the slots go to the waiting lookups in the order of their finish tags: every lookup of a
+    key is 1 / weight after the last one of the same key, but never before the one which got the last slot. A key with
+    a lot of waiting lookups is far ahead with its tags, so a key with only one gets the next slot.
+    """
+
+    def __init__(
+        self,
+        queue_limit: int = QUEUE_LIMIT,
+        max_wait: float = MAX_WAIT,
+    ) -> None:
+        self.queue_limit = queue_limit
+        self.max_wait = max_wait
+        # the lookups which hold a slot, and how many there are. The capacity changes with the flood waits
+        self.running = 0
+        self.capacity = LOOKUPS_PER_CLIENT
+        # the waiting lookups as a heap of their finish tag, a number to keep the order of equal tags, and the future
+        # which gets a result once the lookup has a slot
+        self.waiting: "List[Tuple[float, int, asyncio.Future[None]]]" = []
+        self.counter = itertools.count()
+        # the tag of the lookup which got the last slot, and the last tag of every key
+        self.virtual_time = 0.0
+        self.finish_tags: "Dict[str, float]" = {}
+        # how long a lookup holds its slot, on average
+        self.service_time = SERVICE_TIME
+
+    def admit(
+        self, api_key: str, capacity: int
+    ) -> "Union[None, int, asyncio.Future[None]]":
+        """
+        This returns None if the lookup can start right away, and a future to wait for otherwise. If it would have to
+        wait too long, it returns the seconds the caller should wait before trying again instead.
+        """
+        self.capacity = capacity
+        self.dispatch()
+        if self.running < capacity and not self.waiting:
+            self.running += 1
+            return None
+        tag = max(self.virtual_time, self.finish_tags.get(api_key, 0.0)) + 1 / (
+            KEY_WEIGHTS.get(api_key, 1)
+        )
+        # the lookups before this one in line, they all need a slot first
+        ahead = sum(
+            1 for entry in self.waiting if entry[0] <= tag and not entry[2].done()
+        )
+        expected = (ahead + 1) * self.service_time / capacity
+        if len(self.waiting) >= self.queue_limit or expected > self.max_wait:
+            return max(1, math.ceil(expected))
+        self.finish_tags[api_key] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (tag, next(self.counter), future))
+        return future
+
+    def dispatch(self) -> None:
+        # the free slots go to the lookups with the lowest tags. Some of them might have given up already
+        while self.waiting and self.running < self.capacity:
+            tag, _, future = heapq.heappop(self.waiting)
+            if future.done():
+                continue
+            self.virtual_time = tag
+            self.running += 1
+            future.set_result(None)
+
+    def release(self, seconds: "Optional[float]" = None) -> None:
+        # this is called once the lookup is done, with how long it took. Without it, the slot wasn't used
+        if seconds is not None:
+            self.service_time += (seconds - self.service_time) * SMOOTHING
+        self.running -= 1
+        self.dispatch()
+
+    def leave(self, future: "asyncio.Future[None]") -> None:
+        # the caller doesn't wait anymore. If the lookup got a slot in the meantime, it is given back
+        if future.done() and not future.cancelled():
+            self.release()
+        else:
+            future.cancel()
+
+
+# the queue of this process
+admission = AdmissionQueue()
+
+Gauge(
+    "admission_waiting",
+    "New lookups waiting for a slot.",
+    lambda: sum(1 for entry in admission.waiting if not entry[2].done()),
+)
+Gauge("admission_running", "Lookups holding a slot.", lambda: admission.running)
@@ -1,10 +1,24 @@
-from typing import Mapping
+from typing import Mapping, Tuple
 
 # the allowed keys are a dict of strings, mapping keys to project names. These names are used in the stats message which
 # is send regularly, at least in the first days of this API. I use the 4 word "sentences" as below because they are
 # funny, but you can do whatever you want. This implementations means a restart of the service is necessary to add a
 # new key, but that's not an issue for now
 ALLOWED_KEYS: Mapping[str, str] = {"RationalGymsGripOverseas": "VeryCoolProject"}
+# these are the rate limits of the keys. "cache" is for usernames we can answer from the cache, "upstream" for the ones
+# we have to ask the website or the API about. Each of them is how many usernames per second a key gets, and how many
+# it can save up for a burst. Keys which aren't in KEY_LIMITS get DEFAULT_LIMITS, and a budget which isn't there isn't
+# limited at all. A rate of 0 makes the burst a fixed quota until restart. Every worker has its own limits
+DEFAULT_LIMITS: Mapping[str, Tuple[float, float]] = {
+    "cache": (100, 1000),
+    "upstream": (1, 60),
+}
+KEY_LIMITS: Mapping[str, Mapping[str, Tuple[float, float]]] = {
+    "RationalGymsGripOverseas": {"cache": (100, 1000), "upstream": (1, 60)}
+}
+# if lookups have to wait for the API, the keys take turns. A key with a higher weight gets that many more turns, keys
+# which aren't in here have a weight of 1
+KEY_WEIGHTS: Mapping[str, float] = {}
 # these are taken from my.telegram.org, you have to get your own
 api_id: int = 1234
 api_hash: str = "Wuhu"
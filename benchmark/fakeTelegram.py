@@ -0,0 +1,330 @@
+import asyncio
+import html
+import random
+import zlib
+from types import SimpleNamespace
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+from telethon import errors
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.contacts import ResolveUsernameRequest
+from telethon.tl.functions.users import GetFullUserRequest
+from telethon.tl.types import PeerChannel, PeerUser
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional, Set, Tuple
+
+# this module stands in for telegram during the benchmark: a web server which serves t.me pages, and a client which
+# answers the two API calls we make. Both know the same made up usernames, so the website and the API agree
+
+# every tenth username is a supergroup, every fifth a channel, every tenth doesn't exist and the rest are users
+CHAT_TYPES = (
+    "private",
+    "private",
+    "channel",
+    "private",
+    "supergroup",
+    "private",
+    "private",
+    "channel",
+    "private",
+    "not_found",
+)
+
+# the real pages have a lot of markup around the parts we read, this keeps the size and the shape of it
+PAGE = """<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    <title>Telegram: Contact @{username}</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, minimum-scale=1.0, maximum-scale=1.0, user-scalable=no">
+    <meta property="og:title" content="{title}">
+    <meta property="og:image" content="https://cdn4.telesco.pe/file/{padding}.jpg">
+    <meta property="og:site_name" content="Telegram">
+    <meta property="og:description" content="{og_description}">
+    <meta property="twitter:title" content="{title}">
+    <meta property="twitter:description" content="{og_description}">
+    <meta name="robots" content="noindex, nofollow">
+    <link rel="icon" type="image/svg+xml" href="//telegram.org/img/website_icon.svg?4">
+    <link rel="apple-touch-icon" sizes="180x180" href="//telegram.org/img/apple-touch-icon.png">
+    <link href="//telegram.org/css/font-roboto.css?1" rel="stylesheet" type="text/css">
+    <link href="//telegram.org/css/bootstrap.min.css?3" rel="stylesheet">
+    <link href="//telegram.org/css/telegram.css?236" rel="stylesheet" media="screen">
+    <script>window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches && document.documentElement && document.documentElement.classList && document.documentElement.classList.add('theme_dark');</script>
+  </head>
+  <body class="no_transition">
+    <div class="tgme_background_wrap">
+      <canvas id="tgme_background" class="tgme_background default" width="50" height="50" data-colors="dbddbb,6ba587,d5d88d,88b884"></canvas>
+      <div class="tgme_background_pattern default"></div>
+    </div>
+    <div class="tgme_page_wrap">
+      <div class="tgme_head_wrap">
+        <div class="tgme_head">
+          <a href="//telegram.org/" class="tgme_head_brand">
+            <svg class="tgme_logo" height="34" viewBox="0 0 133 34" width="133" xmlns="http://www.w3.org/2000/svg"><g fill="none" fill-rule="evenodd"><circle cx="17" cy="17" fill="var(--accent-btn-color)" r="17"/><path d="m7.1 16.9c5.2-2.1 8.7-3.5 10.5-4.2 5-1.9 6-2.2 6.7-2.3.1 0 .5 0 .7.2.2.1.2.3.3.4v.7c-.3 2.6-1.4 9-2 11.9-.3 1.2-.7 1.5-1.2 1.6-1 .1-1.8-.5-2.8-1.1-1.6-1-2.4-1.6-4-2.6" fill="#fff"/></g></svg>
+          </a>
+          <a class="tgme_head_dl_button" href="//telegram.org/dl?tme=0">Download</a>
+        </div>
+      </div>
+      <div class="tgme_body_wrap">
+        <div class="tgme_page">
+          <div class="tgme_page_photo">
+            <a href="tg://resolve?domain={username}"><img class="tgme_page_photo_image" src="https://cdn4.telesco.pe/file/{padding}.jpg"></a>
+          </div>
+          <div class="tgme_page_title" dir="auto"><span dir="auto">{title}</span></div>
+{extra}{description}          <div class="tgme_page_action">
+            <a class="tgme_action_button_new shine" href="tg://resolve?domain={username}">View in Telegram</a>
+          </div>
+          <div class="tgme_page_additional">
+            If you have <strong>Telegram</strong>, you can contact <a class="tgme_username_link" href="tg://resolve?domain={username}">@{username}</a> right away.
+          </div>
+        </div>
+      </div>
+    </div>
+    <div id="tgme_frame_cont"></div>
+    <script src="//telegram.org/js/tgwallpaper.min.js?3"></script>
+    <script type="text/javascript">
+var protoUrl = "tg:\\/\\/resolve?domain={username}";
+if (false) {{
+  var iframeContEl = document.getElementById('tgme_frame_cont') || document.body;
+  var iframeEl = document.createElement('iframe');
+  iframeContEl.appendChild(iframeEl);
+  var pageHidden = false;
+  window.addEventListener('pagehide', function () {{ pageHidden = true; }}, false);
+  window.addEventListener('blur', function () {{ pageHidden = true; }}, false);
+  if (iframeEl !== null) {{ iframeEl.src = protoUrl; }}
+  !false && setTimeout(function() {{ if (!pageHidden) {{ window.location = protoUrl; }} }}, 2000);
+}}
+else if (protoUrl) {{
+  setTimeout(function() {{ window.location = protoUrl; }}, 100);
+}}
+var tme_bg = document.getElementById('tgme_background');
+if (tme_bg) {{
+  TWallpaper.init(tme_bg);
+  TWallpaper.scrollAnimate(true);
+}}
+    </script>
+  </body>
+</html>
+"""
+
+
+def chat_for(index: int) -> "Tuple[str, Optional[dict]]":
+    # this makes up the username with the given index and the chat behind it. Not existing ones have no chat
+    username = f"bench{index:06d}"
+    chat_type = CHAT_TYPES[index % len(CHAT_TYPES)]
+    if chat_type == "not_found":
+        return username, None
+    chat = {
+        "id": 1000000 + index,
+        "type": chat_type,
+        "first_name": f"Bench & Co {index}" if chat_type == "private" else "",
+        "last_name": f"Number {index}" if chat_type == "private" and index % 3 else "",
+        "title": f"The <{index}> chat" if chat_type != "private" else "",
+        "bio": (
+            f'Line one of {index}\nline two, with "quotes" & more' if index % 4 else ""
+        ),
+        "members": index * 7 + 3,
+    }
+    return username, chat
+
+
+def page_for(username: str, chat: "Optional[dict]") -> str:
+    # this renders the t.me page the way telegram does it. Pages of not existing usernames have no extra and no
+    # description
+    padding = f"{zlib.crc32(username.encode()):08x}" * 16
+    if chat is None:
+        return PAGE.format(
+            username=username,
+            title=html.escape(f"Telegram: Contact @{username}"),
+            og_description="",
+            padding=padding,
+            extra="",
+            description="",
+        )
+    if chat["type"] == "private":
+        title = chat["first_name"]
+        if chat["last_name"]:
+            title += " " + chat["last_name"]
+        extra = "@" + username
+    else:
+        title = chat["title"]
+        members = f"{chat['members']:,}".replace(",", " ")
+        if chat["type"] == "channel":
+            extra = f"{members} subscribers"
+        else:
+            extra = f"{members} members, {chat['members'] // 10} online"
+    description = ""
+    if chat["bio"]:
+        description = (
+            '          <div class="tgme_page_description" dir="auto">'
+            + html.escape(chat["bio"], quote=False).replace("\n", "<br/>")
+            + "</div>\n"
+        )
+    return PAGE.format(
+        username=username,
+        title=html.escape(title),
+        og_description=html.escape(chat["bio"]),
+        padding=padding,
+        extra=f'          <div class="tgme_page_extra">{extra}</div>\n',
+        description=description,
+    )
+
+
+class FakeTelegram:
+    """
+    This holds the made up usernames, serves their pages and counts how often the website and the API were asked.
+    """
+
+    def __init__(self, usernames: int, website_latency: float) -> None:
+        self.website_latency = website_latency
+        self.chats: "Dict[str, Optional[dict]]" = {}
+        # the API reaches chats by their id once the username is resolved
+        self.usernames: "Dict[int, str]" = {}
+        # the pages are rendered once, the benchmark is supposed to measure us, not the fake
+        self.pages: "Dict[str, bytes]" = {}
+        for index in range(usernames):
+            username, chat = chat_for(index)
+            self.chats[username] = chat
+            if chat:
+                self.usernames[chat["id"]] = username
+            self.pages[username] = page_for(username, chat).encode()
+        self.website_calls = 0
+        self.api_calls = 0
+
+    def existing(self) -> "List[str]":
+        return [username for username, chat in self.chats.items() if chat]
+
+    async def page(self, request: web.Request) -> web.Response:
+        self.website_calls += 1
+        await asyncio.sleep(self.website_latency)
+        username = request.match_info["username"].lower()
+        body = self.pages.get(username) or page_for(username, None).encode()
+        return web.Response(body=body, content_type="text/html", charset="utf-8")
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/{username}", self.page)
+        return app
+
+
+class FakeClient:
+    """
+    This stands in for a TelegramClient. It answers ResolveUsernameRequest, GetFullUserRequest and
+    GetFullChannelRequest from the made up chats after some latency, raises the same errors telethon does, and raises a
+    FloodWaitError every now and then. Like telethon, it has to resolve a username it is given in a full request first,
+    unless it resolved that username before.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        telegram: FakeTelegram,
+        latency: float,
+        flood_rate: float = 0.0,
+        flood_seconds: int = 2,
+    ) -> None:
+        # the pool uses the session filename as the name of the client
+        self.session = SimpleNamespace(filename=name)
+        self.telegram = telegram
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        # the usernames telethon would have in the entity cache of the session
+        self.resolved: "Set[str]" = set()
+
+    async def call(self) -> None:
+        # every request to telegram takes the latency and might get a flood wait
+        self.telegram.api_calls += 1
+        await asyncio.sleep(self.latency)
+        if random.random() < self.flood_rate:
+            raise errors.FloodWaitError(request=None, capture=self.flood_seconds)
+
+    async def __call__(self, request):  # type: ignore[no-untyped-def]
+        if isinstance(request, ResolveUsernameRequest):
+            await self.call()
+            chat = self.telegram.chats.get(request.username.lower())
+            if chat is None:
+                raise errors.UsernameNotOccupiedError(request=request)
+            self.resolved.add(request.username.lower())
+            if chat["type"] == "private":
+                return SimpleNamespace(
+                    peer=PeerUser(chat["id"]),
+                    users=[SimpleNamespace(id=chat["id"], access_hash=0)],
+                    chats=[],
+                )
+            return SimpleNamespace(
+                peer=PeerChannel(chat["id"]),
+                users=[],
+                chats=[
+                    SimpleNamespace(
+                        id=chat["id"],
+                        access_hash=0,
+                        megagroup=chat["type"] == "supergroup",
+                    )
+                ],
+            )
+        peer = (
+            request.id if isinstance(request, GetFullUserRequest) else request.channel
+        )
+        if isinstance(peer, str):
+            # the username is passed straight into the request, telethon resolves it if it has to
+            username = peer
+            chat = self.telegram.chats.get(username.lower())
+            if username.lower() not in self.resolved:
+                await self.call()
+                if chat is None:
+                    raise ValueError(f'No user has "{username}" as username')
+                self.resolved.add(username.lower())
+        else:
+            # the made up chats all have the access hash 0, so any other one is as good as an outdated one
+            if peer.access_hash != 0:
+                await self.call()
+                if isinstance(request, GetFullUserRequest):
+                    raise errors.UserIdInvalidError(request=request)
+                raise errors.ChannelInvalidError(request=request)
+            username = self.telegram.usernames[
+                (
+                    peer.user_id
+                    if isinstance(request, GetFullUserRequest)
+                    else peer.channel_id
+                )
+            ]
+            chat = self.telegram.chats[username]
+        # telethon finds out that the type is wrong without asking telegram
+        if isinstance(request, GetFullUserRequest) and chat["type"] != "private":
+            raise TypeError("Cannot cast InputPeerChannel to any kind of InputUser.")
+        if isinstance(request, GetFullChannelRequest) and chat["type"] == "private":
+            raise TypeError("Cannot cast InputPeerUser to any kind of InputChannel.")
+        await self.call()
+        if isinstance(request, GetFullUserRequest):
+            return SimpleNamespace(
+                users=[
+                    SimpleNamespace(
+                        id=chat["id"],
+                        access_hash=0,
+                        username=username,
+                        usernames=None,
+                        first_name=chat["first_name"],
+                        last_name=chat["last_name"] or None,
+                    )
+                ],
+                full_user=SimpleNamespace(about=chat["bio"] or None),
+            )
+        return SimpleNamespace(
+            chats=[
+                SimpleNamespace(
+                    id=chat["id"],
+                    access_hash=0,
+                    username=username,
+                    usernames=None,
+                    title=chat["title"],
+                )
+            ],
+            full_chat=SimpleNamespace(about=chat["bio"] or None),
+        )
+
+    async def send_message(self, *args, **kwargs) -> None:  # type: ignore[no-untyped-def]
+        # the log messages go nowhere
+        pass
@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import math
+import random
+import time
+from collections import Counter
+from typing import TYPE_CHECKING
+
+from aiohttp import web, ClientSession, TCPConnector
+
+import rateLimit
+import resolveUsername
+from api_keys import ALLOWED_KEYS
+from cacheStore import MemoryStore, UsernameCache
+from clientPool import ClientPool
+from main import create_app
+from scrapeClient import ScrapeClient
+from benchmark.fakeTelegram import FakeTelegram, FakeClient, chat_for
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Tuple
+
+# this runs the real app against the fakes from fakeTelegram and reports how many requests per second it answers and
+# how long they take. Run it from the root of the repository with python -m benchmark.loadTest, and compare the numbers
+# before and after a change
+
+SCENARIOS = ("hit", "miss", "zipf", "flood")
+
+
+def warm_cache(telegram: FakeTelegram) -> UsernameCache:
+    # a cache which knows every existing username and verified it just now, like the API would have filled it
+    cache = UsernameCache(MemoryStore())
+    for index in range(len(telegram.chats)):
+        username, chat = chat_for(index)
+        if chat is None:
+            continue
+        private = chat["type"] == "private"
+        cache[username] = {
+            "first_name": chat["first_name"] if private else chat["title"],
+            # the lookups store None for a missing last name or bio as well, whatever the type hints say
+            "last_name": (chat["last_name"] or None) if private else "",  # type: ignore[typeddict-item]
+            "bio": chat["bio"] or None,  # type: ignore[typeddict-item]
+            "chat_type": chat["type"],
+            "chat_id": chat["id"],
+            "verified": time.time(),
+            "access_hashes": None,
+        }
+    return cache
+
+
+def zipf_usernames(
+    usernames: "List[str]", requests: int, exponent: float
+) -> "List[str]":
+    # the first usernames of the shuffled list are the popular ones, the weight of rank n is 1 / n ** exponent
+    ranked = random.sample(usernames, len(usernames))
+    weights = [1 / rank**exponent for rank in range(1, len(ranked) + 1)]
+    return random.choices(ranked, weights=weights, k=requests)
+
+
+def percentile(latencies: "List[float]", fraction: float) -> float:
+    # the latencies have to be sorted, this is the nearest rank method
+    return latencies[max(0, math.ceil(fraction * len(latencies)) - 1)]
+
+
+async def load(
+    url: str, api_key: str, usernames: "List[str]", concurrency: int
+) -> "Tuple[float, List[float], Counter]":
+    # this sends the requests from a fixed number of workers, each one sends its next request as soon as the last one
+    # is answered
+    latencies: "List[float]" = []
+    statuses: Counter = Counter()
+    queue = iter(usernames)
+    connector = TCPConnector(limit=concurrency)
+    async with ClientSession(connector=connector) as session:
+
+        async def worker() -> None:
+            for username in queue:
+                start = time.perf_counter()
+                async with session.get(
+                    url, params={"api_key": api_key, "username": username}
+                ) as response:
+                    await response.read()
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+    return duration, sorted(latencies), statuses
+
+
+async def run_scenario(
+    scenario: str, arguments: argparse.Namespace
+) -> "Dict[str, object]":
+    telegram = FakeTelegram(arguments.usernames, arguments.website_latency)
+    flood_rate = arguments.flood_rate if scenario == "flood" else 0.0
+    clients = ClientPool(
+        [
+            FakeClient(
+                f"bench_{number}", telegram, arguments.api_latency, flood_rate, 2
+            )
+            for number in range(arguments.clients)
+        ]
+    )
+    # every scenario starts without anything the last one left behind
+    resolveUsername.in_flight.clear()
+    resolveUsername.not_found.clear()
+    # the benchmark measures the API, the rate limits would only get in the way
+    rateLimit.KEY_LIMITS = {}
+    rateLimit.DEFAULT_LIMITS = {}
+    existing = telegram.existing()
+    if scenario == "hit":
+        cache = warm_cache(telegram)
+        usernames = random.choices(existing, k=arguments.requests)
+    elif scenario == "miss":
+        cache = UsernameCache(MemoryStore())
+        # every username is asked for once, so nothing can come from the cache
+        usernames = random.sample(existing, min(arguments.requests, len(existing)))
+    elif scenario == "zipf":
+        cache = UsernameCache(MemoryStore())
+        usernames = zipf_usernames(
+            list(telegram.chats), arguments.requests, arguments.zipf_exponent
+        )
+    else:
+        cache = UsernameCache(MemoryStore())
+        usernames = random.choices(existing, k=arguments.requests)
+
+    # the session is the same the real app uses, with all its limits
+    session = ScrapeClient()
+    try:
+        app = create_app(clients, cache, session)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host="127.0.0.1", port=0).start()
+        website = web.AppRunner(telegram.create_app())
+        await website.setup()
+        await web.TCPSite(website, host="127.0.0.1", port=0).start()
+        # both run on a free port, the addresses tell us which one
+        resolveUsername.WEBSITE_URL = f"http://127.0.0.1:{website.addresses[0][1]}/"
+        port = runner.addresses[0][1]
+        try:
+            duration, latencies, statuses = await load(
+                f"http://127.0.0.1:{port}/resolveUsername",
+                next(iter(ALLOWED_KEYS)),
+                usernames,
+                arguments.concurrency,
+            )
+        finally:
+            await runner.cleanup()
+            await website.cleanup()
+    finally:
+        await session.close()
+    return {
+        "scenario": scenario,
+        "requests": len(latencies),
+        "rps": len(latencies) / duration,
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "website": telegram.website_calls,
+        "api": telegram.api_calls,
+        "statuses": " ".join(
+            f"{status}:{count}" for status, count in sorted(statuses.items())
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run the API against a fake telegram and measure it."
+    )
+    # this can be given more then once, without it all scenarios run
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--usernames", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=2)
+    parser.add_argument("--website-latency", type=float, default=0.05)
+    parser.add_argument("--api-latency", type=float, default=0.1)
+    parser.add_argument("--flood-rate", type=float, default=0.05)
+    parser.add_argument("--zipf-exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    print(
+        f"{'scenario':<10}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'website':>10}{'api':>8}  statuses"
+    )
+    for scenario in arguments.scenario or SCENARIOS:
+        result = asyncio.run(run_scenario(scenario, arguments))
+        print(
+            f"{result['scenario']:<10}{result['requests']:>10}{result['rps']:>10.1f}{result['p50']:>10.1f}"
+            f"{result['p95']:>10.1f}{result['p99']:>10.1f}{result['website']:>10}{result['api']:>8}  "
+            f"{result['statuses']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,663 @@
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import TYPE_CHECKING, cast
+
+import ujson as json
+
+from metrics import CACHE_EVICTIONS
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Generator, Iterator, List, Optional, Set, Tuple
+
+    from main import Username
+
+# this module takes care of keeping the cache on disk. The cache itself stays a mapping in memory, every change to it is
+# handed to a store, which writes it to disk without blocking the event loop
+
+
+class CacheStore:
+    """
+    This is the interface every store has to provide. chunks is used once at startup, put and delete for every change
+    of the cache. They must not block, the actual writing happens somewhere else. compact is called regularly in the
+    background and close when we shut down.
+    """
+
+    def load(self) -> "Dict[str, Username]":
+        raise NotImplementedError
+
+    def chunks(self) -> "Generator[List[Tuple[str, Username]], None, None]":
+        # this reads the entries in parts, the most recently verified first. It may block, it runs in a thread
+        yield list(self.load().items())
+
+    def adopt(self, key: str, entry: "Username") -> None:
+        # this is called for every entry from chunks the cache takes, stores which keep the entries in memory need it
+        pass
+
+    def put(self, key: str, entry: "Username") -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def fetch(self, key: str) -> "Optional[Username]":
+        # this reads one entry from disk. Stores which can't do that return None
+        return None
+
+    def fetch_chat_id(self, chat_id: int) -> "List[Tuple[str, Username]]":
+        # same, but for the entries with this chat_id (without the -100 of the bot api)
+        return []
+
+    async def compact(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+# this is how many entries are read from the database at once while the cache is loaded
+LOAD_CHUNK = 10000
+
+
+class SqliteStore(CacheStore):
+    """
+    This keeps the cache in a SQLite database in WAL mode. Changes go into a queue and a single writer thread commits
+    them in batches, so an entry is on disk shortly after the API gave it to us, and a crash can't corrupt the file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # the changes which still have to be written. Each one is the operation, its parameters and an event, if
+        # someone waits for it to be done
+        self.queue: "queue.Queue[Tuple[str, tuple, Optional[threading.Event]]]" = (
+            queue.Queue()
+        )
+        # the table is created here already, so load works before the writer thread is up
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS usernames "
+                "(username TEXT PRIMARY KEY, chat_id INTEGER, data TEXT NOT NULL)"
+            )
+            # this is for looking up usernames by the chat id
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS usernames_chat_id ON usernames (chat_id)"
+            )
+        connection.close()
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+        # this connection reads single entries on the event loop, it is created the first time it is needed
+        self.reader: "Optional[sqlite3.Connection]" = None
+
+    def connect(self, same_thread: bool = True) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=same_thread)
+        # incremental vacuum only works if it is set before the first table is created, otherwise this does nothing
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL lets us read while writing, and a crash in the middle of a write only loses that write
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        # with more than one worker, someone else might be writing right now. We wait for them instead of failing
+        connection.execute("PRAGMA busy_timeout = 5000")
+        return connection
+
+    def load(self) -> "Dict[str, Username]":
+        connection = self.connect()
+        try:
+            return {
+                username: json.loads(data)
+                for username, data in connection.execute(
+                    "SELECT username, data FROM usernames"
+                )
+            }
+        finally:
+            connection.close()
+
+    def chunks(self) -> "Generator[List[Tuple[str, Username]], None, None]":
+        # the chunks are read by whichever thread of the executor is free, one after another
+        connection = self.connect(same_thread=False)
+        try:
+            cursor = connection.execute(
+                "SELECT username, data FROM usernames "
+                "ORDER BY json_extract(data, '$.verified') DESC"
+            )
+            while True:
+                rows = cursor.fetchmany(LOAD_CHUNK)
+                if not rows:
+                    return
+                yield [(username, json.loads(data)) for username, data in rows]
+        finally:
+            connection.close()
+
+    def put(self, key: str, entry: "Username") -> None:
+        # the entry is encoded right away, so later changes to the dict don't race with the writer thread
+        self.queue.put(("put", (key, entry["chat_id"], json.dumps(entry)), None))
+
+    def delete(self, key: str) -> None:
+        self.queue.put(("delete", (key,), None))
+
+    def fetch(self, key: str) -> "Optional[Username]":
+        # a lookup by primary key takes a few microseconds, so this doesn't need a thread
+        if self.reader is None:
+            self.reader = self.connect()
+        row = self.reader.execute(
+            "SELECT data FROM usernames WHERE username = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def fetch_chat_id(self, chat_id: int) -> "List[Tuple[str, Username]]":
+        if self.reader is None:
+            self.reader = self.connect()
+        return [
+            (username, json.loads(data))
+            for username, data in self.reader.execute(
+                "SELECT username, data FROM usernames WHERE chat_id = ?", (chat_id,)
+            )
+        ]
+
+    def flush(self) -> None:
+        # this blocks until everything which was queued before is written, so don't call it on the event loop
+        done = threading.Event()
+        self.queue.put(("flush", (), done))
+        done.wait()
+
+    async def compact(self) -> None:
+        # the writer thread does the compacting between two batches, we only wait for it without blocking the loop
+        done = threading.Event()
+        self.queue.put(("compact", (), done))
+        await asyncio.get_running_loop().run_in_executor(None, done.wait)
+
+    def close(self) -> None:
+        done = threading.Event()
+        self.queue.put(("close", (), done))
+        done.wait()
+
+    def write(self) -> None:
+        # this runs in its own thread for the whole lifetime of the store
+        connection = self.connect()
+        while True:
+            # we wait for the first change, and then take everything else which is waiting as well, so a burst of
+            # changes ends up in one transaction
+            operations = [self.queue.get()]
+            while True:
+                try:
+                    operations.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(connection, operations)
+            except sqlite3.Error:
+                # we rather lose this batch than the writer thread, the entries are still in memory and get written
+                # again the next time they change
+                logging.exception("Writing to the cache database failed")
+            # the other operations wait for the batch to be committed
+            for operation, _, done in operations:
+                try:
+                    if operation == "compact":
+                        # this moves the WAL into the database file and hands the free pages back to the file system
+                        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                        connection.execute("PRAGMA incremental_vacuum")
+                    elif operation == "close":
+                        connection.close()
+                except sqlite3.Error:
+                    logging.exception("Compacting the cache database failed")
+                if done:
+                    done.set()
+                if operation == "close":
+                    return
+
+    @staticmethod
+    def write_batch(
+        connection: sqlite3.Connection,
+        operations: "List[Tuple[str, tuple, Optional[threading.Event]]]",
+    ) -> None:
+        # all changes of one batch are written in one transaction
+        with connection:
+            for operation, parameters, _ in operations:
+                if operation == "put":
+                    connection.execute(
+                        "INSERT OR REPLACE INTO usernames VALUES (?, ?, ?)",
+                        parameters,
+                    )
+                elif operation == "delete":
+                    connection.execute(
+                        "DELETE FROM usernames WHERE username = ?", parameters
+                    )
+
+
+class JsonStore(CacheStore):
+    """
+    This is the old way of keeping the cache: one json file, which is rewritten in full every time compact is called.
+    The file is written in a thread, into a temporary file first, so a crash while saving doesn't corrupt it.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.data: "Dict[str, Username]" = {}
+        # we only rewrite the file if something changed since the last time
+        self.changed = False
+
+    def load(self) -> "Dict[str, Username]":
+        self.data = read_json(self.path) if os.path.exists(self.path) else {}
+        return self.data
+
+    def put(self, key: str, entry: "Username") -> None:
+        # the cache keeps its own compact entries, so the dicts for the file are kept here
+        self.data[key] = entry
+        self.changed = True
+
+    def delete(self, key: str) -> None:
+        self.data.pop(key, None)
+        self.changed = True
+
+    def chunks(self) -> "Generator[List[Tuple[str, Username]], None, None]":
+        # the file can only be read as a whole. The entries are only taken into data once the cache adopts them, so
+        # changes which happen while the file is read aren't overwritten
+        if os.path.exists(self.path):
+            yield sorted(
+                read_json(self.path).items(),
+                key=lambda item: item[1].get("verified", 0),
+                reverse=True,
+            )
+
+    def adopt(self, key: str, entry: "Username") -> None:
+        self.data[key] = entry
+
+    def fetch(self, key: str) -> "Optional[Username]":
+        # the file has every entry, so the ones the cache evicted are still here
+        return self.data.get(key)
+
+    def fetch_chat_id(self, chat_id: int) -> "List[Tuple[str, Username]]":
+        return [
+            (username, entry)
+            for username, entry in self.data.items()
+            if entry["chat_id"] == chat_id
+        ]
+
+    async def compact(self) -> None:
+        if not self.changed:
+            return
+        self.changed = False
+        # the copy is taken on the event loop, so the dict doesn't change while the thread writes it
+        snapshot = dict(self.data)
+        await asyncio.get_running_loop().run_in_executor(
+            None, write_json, self.path, snapshot
+        )
+
+    def close(self) -> None:
+        write_json(self.path, self.data)
+
+
+class MemoryStore(CacheStore):
+    """
+    This keeps nothing on disk, for the benchmark.
+    """
+
+    def load(self) -> "Dict[str, Username]":
+        return {}
+
+    def put(self, key: str, entry: "Username") -> None:
+        pass
+
+    def delete(self, key: str) -> None:
+        pass
+
+    async def compact(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def read_json(path: str) -> "Dict[str, Username]":
+    with open(path, "rb") as infile:
+        return json.load(infile)
+
+
+def write_json(path: str, data: "Dict[str, Username]") -> None:
+    # the file is written next to the real one and then swapped in, which is atomic
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as outfile:
+        # and here it gets dumped, with the indent of 4 and sorted keys, so its nice to look at
+        json.dump(data, outfile, indent=4, sort_keys=True)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temporary_path, path)
+
+
+# the bot api puts -100 in front of the ids of supergroups and channels. This also keeps them apart from user ids, which
+# can be the same number. The ids have ten digits, so this is the same as subtracting them from this
+BOT_API_OFFSET = -1000000000000
+
+
+def bot_api_id(entry: "Username") -> int:
+    if entry["chat_type"] == "private":
+        return entry["chat_id"]
+    return BOT_API_OFFSET - entry["chat_id"]
+
+
+class CacheEntry:
+    """
+    This is one entry of the cache. It can be read and changed like the Username dict, but the keys aren't stored with
+    every entry, and the chat type is interned, so all entries share the same few strings. The response for the entry
+    is kept here as well once it was encoded, so cache hits don't have to encode it again.
+    """
+
+    __slots__ = (
+        "bio",
+        "chat_id",
+        "chat_type",
+        "first_name",
+        "last_name",
+        "verified",
+        "access_hashes",
+        "encoded",
+    )
+
+    # these are the keys of the Username dict, the encoded response isn't one of them
+    keys = __slots__[:7]
+    # and these aren't part of the response
+    unencoded = frozenset(("verified", "access_hashes"))
+
+    def __init__(self, entry: "Username") -> None:
+        self.bio = entry["bio"]
+        self.chat_id = entry["chat_id"]
+        self.chat_type = sys.intern(entry["chat_type"])
+        self.first_name = entry["first_name"]
+        self.last_name = entry["last_name"]
+        # entries from before we stored the timestamp count as very old
+        self.verified = entry.get("verified", 0)
+        # the session names are the same for all entries, so they are interned as well. Entries from before we stored
+        # them don't have any
+        access_hashes = entry.get("access_hashes")
+        self.access_hashes = (
+            {sys.intern(name): value for name, value in access_hashes.items()}
+            if access_hashes
+            else None
+        )
+        # the response body without the username, split where it goes. resolveUsername fills this in
+        self.encoded: "Optional[Tuple[bytes, bytes]]" = None
+
+    def __getitem__(self, key: str) -> "Any":
+        if key not in self.keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: "Any") -> None:
+        if key not in self.keys:
+            raise KeyError(key)
+        setattr(self, key, value)
+        # the timestamp and the access hashes aren't part of the response, everything else is
+        if key not in self.unencoded:
+            self.encoded = None
+
+    def get(self, key: str, default: "Any" = None) -> "Any":
+        return getattr(self, key) if key in self.keys else default
+
+    def as_dict(self) -> "Username":
+        # this is what the stores write to disk
+        return {
+            "bio": self.bio,
+            "chat_id": self.chat_id,
+            "chat_type": self.chat_type,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "verified": self.verified,
+            "access_hashes": self.access_hashes,
+        }
+
+    def size(self) -> int:
+        # roughly the bytes this entry takes. The chat type is shared by all entries, so it doesn't count. Neither does
+        # the encoded response, it comes and goes after the entry was counted
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.bio)
+            + sys.getsizeof(self.chat_id)
+            + sys.getsizeof(self.first_name)
+            + sys.getsizeof(self.last_name)
+            + sys.getsizeof(self.verified)
+            + (
+                sys.getsizeof(self.access_hashes)
+                + sum(map(sys.getsizeof, self.access_hashes.values()))
+                if self.access_hashes
+                else 0
+            )
+        )
+
+
+class UsernameCache(MutableMapping):
+    """
+    This is the cache the endpoints work with. It behaves like the dict it used to be, but hands every change to the
+    store, so it ends up on disk. It also keeps an index from the bot api chat id to the usernames. If it has a limit,
+    the entries which weren't used for the longest time are evicted, and read from the store again when they are asked
+    for. If it is lazy, it starts empty and load has to be awaited, which fills it in the background.
+    """
+
+    def __init__(
+        self,
+        store: CacheStore,
+        shared: bool = False,
+        limit: int = 0,
+        memory_limit: int = 0,
+        lazy: bool = False,
+    ) -> None:
+        self.store = store
+        # the entries in the order they were used, the least recently used one first
+        self.data: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # the most entries we keep, and the most bytes they may take, roughly. 0 means there is no limit
+        self.limit = limit
+        self.memory_limit = memory_limit
+        # the bytes the entries take right now, as far as CacheEntry.size knows
+        self.memory = 0
+        # if other workers write to the same store, an entry we don't have might have been added by them since we
+        # loaded it. The same goes for entries we evicted. In both cases, misses are looked up in the store
+        self.shared = shared
+        self.bounded = bool(limit or memory_limit)
+        # while the cache is loaded, the entries which weren't loaded yet are in the store as well
+        self.loading = lazy
+        self.read_through = shared or self.bounded or lazy
+        # the usernames which were deleted while the cache was loaded, so they don't come back from an older chunk
+        self.dropped: "Set[str]" = set()
+        # this maps the bot api chat id to the usernames of its entries. A chat can have more than one username
+        self.chat_ids: "Dict[int, Set[str]]" = {}
+        if not lazy:
+            chunks = store.chunks()
+            for chunk in chunks:
+                self.add_loaded(chunk)
+                if self.full():
+                    break
+            chunks.close()
+
+    async def load(self) -> int:
+        """
+        This loads the entries from the store in chunks, in a thread, so requests are served in the meantime. Until it
+        is done, misses are looked up in the store. It returns how many entries it read.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = self.store.chunks()
+        loaded = 0
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                loaded += len(chunk)
+                self.add_loaded(chunk)
+                if self.full():
+                    break
+        finally:
+            chunks.close()
+            self.loading = False
+            self.dropped.clear()
+            self.read_through = self.shared or self.bounded
+        return loaded
+
+    def add_loaded(self, chunk: "List[Tuple[str, Username]]") -> None:
+        # the entries come in the most recently verified first, so each one is put in front of the ones before. If they
+        # don't all fit, the old ones are left out. That isn't counted as eviction, they just aren't loaded
+        for key, entry in chunk:
+            # the entries we have already were used since we started, they are newer than the ones in the store
+            if key in self.data or key in self.dropped:
+                continue
+            self.store.adopt(key, entry)
+            if self.full():
+                continue
+            self.insert(key, CacheEntry(entry))
+            self.data.move_to_end(key, last=False)
+
+    def full(self) -> bool:
+        return bool(
+            (self.limit and len(self.data) >= self.limit)
+            or (self.memory_limit and self.memory >= self.memory_limit)
+        )
+
+    def insert(self, key: str, entry: CacheEntry) -> None:
+        # this puts an entry into memory, as the most recently used one. It doesn't touch the store
+        self.forget(key)
+        self.data[key] = entry
+        self.memory += sys.getsizeof(key) + entry.size()
+        self.index(key, entry)
+
+    def forget(self, key: str) -> "Optional[CacheEntry]":
+        # and this takes it out of memory, but not out of the store
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.unindex(key, entry)
+            self.memory -= sys.getsizeof(key) + entry.size()
+        return entry
+
+    def shrink(self) -> int:
+        # this evicts the least recently used entries until we are within the limits again, and returns how many
+        evicted = 0
+        while self.data and (
+            (self.limit and len(self.data) > self.limit)
+            or (self.memory_limit and self.memory > self.memory_limit)
+        ):
+            self.forget(next(iter(self.data)))
+            evicted += 1
+        return evicted
+
+    def index(self, key: str, entry: CacheEntry) -> None:
+        # another entry of the same chat isn't necessarily outdated, the chat might have both usernames. The lookup
+        # drops the ones telegram doesn't list for the chat anymore
+        self.chat_ids.setdefault(bot_api_id(entry), set()).add(key)  # type: ignore[arg-type]
+
+    def drop(self, key: str) -> None:
+        # this takes the entry out of memory and the store
+        self.forget(key)
+        self.store.delete(key)
+        if self.loading:
+            self.dropped.add(key)
+
+    def unindex(self, key: str, entry: CacheEntry) -> None:
+        chat_id = bot_api_id(entry)  # type: ignore[arg-type]
+        keys = self.chat_ids.get(chat_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.chat_ids[chat_id]
+
+    def indexed(self, chat_id: int) -> "Optional[Set[str]]":
+        # the usernames the index has for the chat, with or without the -100
+        keys = self.chat_ids.get(chat_id)
+        if keys is None and chat_id > 0:
+            keys = self.chat_ids.get(BOT_API_OFFSET - chat_id)
+        return keys
+
+    def usernames(self, chat_id: int) -> "Set[str]":
+        """
+        This returns the usernames of all entries for a bot api chat id, which is empty if we don't know the chat. The
+        id of a supergroup or channel can be passed without the -100 as well.
+        """
+        keys = self.indexed(chat_id)
+        if keys is None and self.read_through:
+            # another worker might know it, or we evicted it. The database has the id without the -100
+            raw_id = BOT_API_OFFSET - chat_id if chat_id < BOT_API_OFFSET else chat_id
+            for other_key, entry in self.store.fetch_chat_id(raw_id):
+                self.insert(other_key, CacheEntry(entry))
+            CACHE_EVICTIONS.inc(self.shrink())
+            keys = self.indexed(chat_id)
+        # a copy, the index changes with the cache
+        return set(keys or ())
+
+    def by_chat_id(self, chat_id: int) -> "Optional[str]":
+        """
+        This returns the username for a bot api chat id, or None if we don't know the chat. If the chat has more than
+        one, it is the one which was verified last.
+        """
+        keys = self.usernames(chat_id)
+        if not keys:
+            return None
+        return max(keys, key=lambda key: self.data[key].verified)
+
+    def __getitem__(self, key: str) -> "Username":
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __setitem__(self, key: str, entry: "Username") -> None:
+        # the lookup changes entries it got from us and sets them again, those are already compact
+        compact = entry if isinstance(entry, CacheEntry) else CacheEntry(entry)
+        self.insert(key, compact)
+        self.store.put(key, compact.as_dict())
+        CACHE_EVICTIONS.inc(self.shrink())
+
+    def __delitem__(self, key: str) -> None:
+        # an evicted entry is only in the store, it goes from there all the same
+        if key not in self.data and not (self.read_through and self.store.fetch(key)):
+            raise KeyError(key)
+        self.drop(key)
+
+    def __contains__(self, key: object) -> bool:
+        return self.get(key) is not None  # type: ignore[arg-type]
+
+    def __iter__(self) -> "Iterator[str]":
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key: str, default: "Optional[Username]" = None) -> "Optional[Username]":  # type: ignore[override]
+        # the MutableMapping version goes through an exception for every miss, this is called for every request
+        entry = self.data.get(key)
+        if entry is not None:
+            if self.bounded:
+                # it was used just now, so it is the last one to be evicted
+                self.data.move_to_end(key)
+        elif self.read_through:
+            stored = self.store.fetch(key)
+            if stored is not None:
+                entry = CacheEntry(stored)
+                self.insert(key, entry)
+                CACHE_EVICTIONS.inc(self.shrink())
+        # the entry can be used like the dict, that's all the endpoints need
+        return default if entry is None else cast("Username", entry)
+
+
+def main() -> None:
+    # the json format stays around to move the cache between instances or to look at it
+    parser = argparse.ArgumentParser(
+        description="Import or export the SQLite cache as json."
+    )
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("json_file")
+    parser.add_argument("--database", default="cache.sqlite3")
+    arguments = parser.parse_args()
+    store = SqliteStore(arguments.database)
+    if arguments.action == "export":
+        write_json(arguments.json_file, store.load())
+    else:
+        for key, entry in read_json(arguments.json_file).items():
+            store.put(key, entry)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,16 @@
 from aiohttp import web
+import ujson as json
 from typing import TYPE_CHECKING
 
 from api_keys import ALLOWED_KEYS
+from rateLimit import exhausted
 from resolveUsername import create_error_response
 
 if TYPE_CHECKING:
     from typing import Mapping, Callable, Awaitable
-    from telethon import TelegramClient
+    from clientPool import ClientPool
     from main import Username
-    from aiohttp import ClientSession
+    from scrapeClient import ScrapeClient
 
 
 # This is a generic url checker. It is a bit over the top for the on request this projects supports so far, but it will
@@ -16,11 +18,13 @@ if TYPE_CHECKING:
 async def check_url(
     request: web.Request,
     expected_parameters: list,
-    route_to: "Callable[[web.Request, list[TelegramClient], Mapping[str, Username], ClientSession],"
-    "Awaitable[web.Response]]",
-    clients: "list[TelegramClient]",
+    route_to: (
+        "Callable[[web.Request, ClientPool, Mapping[str, Username], ScrapeClient],"
+        "Awaitable[web.Response]]"
+    ),
+    clients: "ClientPool",
     cache: "Mapping[str, Username]",
-    session: "ClientSession",
+    session: "ScrapeClient",
 ) -> web.Response:
     # this loop goes through all the expected parameters and check if they exists in the URL. If they do not, a Bad
     # Request is thrown, providing the missing parameter
@@ -28,7 +32,9 @@ async def check_url(
         if parameter not in request.rel_url.query:
             error_string = parameter + " is missing."
             return web.json_response(
-                data=create_error_response(400, error_string), status=400
+                data=create_error_response(400, error_string),
+                status=400,
+                dumps=json.dumps,
             )
     # if the api_key parameter is present, this part checks if the key is present in the list of keys. If it is not,
     # an Unauthorized error is thrown
@@ -36,7 +42,20 @@ async def check_url(
         if request.rel_url.query["api_key"] not in ALLOWED_KEYS:
             error_string = "Unauthorized"
             return web.json_response(
-                data=create_error_response(401, error_string), status=401
+                data=create_error_response(401, error_string),
+                status=401,
+                dumps=json.dumps,
+            )
+        # a key which used up all of its budgets is sent away right here. Otherwise, every username takes from the
+        # budget it needs while it is resolved
+        retry_after = exhausted(request.rel_url.query["api_key"])
+        if retry_after:
+            return web.json_response(
+                data=create_error_response(
+                    429, f"Too Many Requests: retry after {retry_after}", retry_after
+                ),
+                status=429,
+                dumps=json.dumps,
             )
     # now the function which is supposed to handle the request gets the request, next to the three initiated objects,
     # which they can not import because of circular imports
@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import logging
+import math
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import TYPE_CHECKING
+
+from metrics import FLOOD_WAIT_SECONDS
+
+if TYPE_CHECKING:
+    from typing import Dict, Iterator, List, Optional, Tuple
+
+    from telethon import TelegramClient
+
+
+# a client which fails to connect or to log in is tried again after this many seconds, the others are used meanwhile
+START_RETRY = 30
+
+# sessions which aren't logged in yet ask for the phone number, this makes sure only one of them asks at a time
+login = asyncio.Lock()
+
+
+def client_name(client: "TelegramClient") -> str:
+    # noinspection PyUnresolvedReferences
+    # the above line is so PyCharm doesn't complain over a valid access. We use the filename as a unique name for the
+    # client, which should make it easy to add more clients in the future
+    return client.session.filename
+
+
+async def start_client(client: "TelegramClient") -> None:
+    """
+    This connects the client and logs it in if it has to. If that fails, it is logged and tried again, until it works.
+    """
+    while True:
+        try:
+            await client.connect()
+            if not await client.is_user_authorized():
+                async with login:
+                    await client.start()
+            return
+        except Exception:
+            logging.exception(
+                "Starting %s failed, trying again in %s seconds",
+                client_name(client),
+                START_RETRY,
+            )
+            await asyncio.sleep(START_RETRY)
+
+
+class FloodRegistry:
+    """
+    This keeps the flood waits in the SQLite database next to the cache, so they are shared by all workers and survive a
+    restart. A worker which starts up doesn't use a session before the wait telegram gave it is over, even if the
+    worker which got the wait died in the meantime.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(path, timeout=5)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS flood_waits (client TEXT PRIMARY KEY, until REAL NOT NULL)"
+            )
+
+    def load(self) -> "Dict[str, float]":
+        # the unix time each client may be used again, for the waits which are not over yet
+        return dict(
+            self.connection.execute(
+                "SELECT client, until FROM flood_waits WHERE until > ?", (time.time(),)
+            )
+        )
+
+    def put(self, name: str, seconds: int) -> None:
+        # this happens once per flood wait, so it is fine to write right away
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO flood_waits VALUES (?, ?)",
+                    (name, time.time() + seconds),
+                )
+        except sqlite3.Error:
+            # the worker which got the wait knows about it anyway
+            logging.exception("Writing the flood wait failed")
+
+
+class ClientPool(Sequence):
+    """
+    This holds the clients and decides which one does the next API call. Clients without a flood wait take turns, the
+    one which wasn't used for the longest time goes first. Clients with a flood wait are kept in a heap sorted by the
+    time their wait ends, and are back in the rotation the moment it does. If the clients aren't started yet, start has
+    to be awaited, and each one joins the rotation once it is connected.
+    """
+
+    def __init__(
+        self,
+        clients: "List[TelegramClient]",
+        registry: "Optional[FloodRegistry]" = None,
+        started: bool = True,
+    ) -> None:
+        self.clients = clients
+        self.named = {client_name(client): client for client in clients}
+        # the clients which are still connecting, and an event for each client which is set once it is connected
+        self.starting = set() if started else set(self.named)
+        self.connected = {name: asyncio.Event() for name in self.named}
+        if started:
+            for event in self.connected.values():
+                event.set()
+        # the clients which can be used right now, the least recently used one first
+        self.available: "OrderedDict[str, TelegramClient]" = OrderedDict(
+            (name, client) for name, client in self.named.items() if started
+        )
+        # this maps the clients in a flood wait to the monotonic time their wait ends
+        self.flood_wait: "Dict[str, float]" = {}
+        # and this is the same as a heap, so we always know which wait ends next. Entries which are outdated because
+        # the client got another flood wait in the meantime are skipped when they come up
+        self.deadlines: "List[Tuple[float, str]]" = []
+        # if there is a registry, it tells every worker about the waits, and tells us about the waits from before we
+        # started
+        self.registry = registry
+        if registry:
+            now = time.time()
+            for name, until in registry.load().items():
+                if name in self.named:
+                    self.wait(name, until - now)
+
+    def wait(self, name: str, seconds: float) -> None:
+        # the client is taken out of the rotation until the wait is over
+        deadline = time.monotonic() + seconds
+        self.flood_wait[name] = deadline
+        heapq.heappush(self.deadlines, (deadline, name))
+        self.available.pop(name, None)
+
+    async def start(self) -> None:
+        """
+        This connects all clients at the same time, and each one joins the rotation as soon as it is connected. Sessions
+        which aren't logged in yet ask for the phone number, one after another. A client which fails doesn't hold up
+        the others, it is tried again until it works.
+        """
+
+        async def start_one(client: "TelegramClient") -> None:
+            await start_client(client)
+            self.started(client)
+
+        await asyncio.gather(*(start_one(client) for client in self.clients))
+
+    async def wait_started(self, client: "TelegramClient") -> None:
+        # this returns once the client is connected
+        await self.connected[client_name(client)].wait()
+
+    def started(self, client: "TelegramClient") -> None:
+        # the client joins the rotation, unless it is in a flood wait, then it joins once that is over
+        name = client_name(client)
+        self.starting.discard(name)
+        self.connected[name].set()
+        if name not in self.flood_wait:
+            self.available[name] = client
+
+    def ready(self) -> bool:
+        return not self.starting
+
+    def __getitem__(self, index):  # type: ignore[no-untyped-def]
+        return self.clients[index]
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def __iter__(self) -> "Iterator[TelegramClient]":
+        return iter(self.clients)
+
+    def readmit(self) -> None:
+        # this puts every client whose flood wait ended back into the rotation
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, name = heapq.heappop(self.deadlines)
+            if self.flood_wait.get(name) != deadline:
+                continue
+            del self.flood_wait[name]
+            # a client which is still connecting joins once it is done
+            if name in self.starting:
+                continue
+            # it didn't do anything for a while, so it goes first
+            self.available[name] = self.named[name]
+            self.available.move_to_end(name, last=False)
+
+    def usable(self) -> int:
+        # this is how many clients are not in a flood wait right now
+        self.readmit()
+        return len(self.available)
+
+    def has_available(self) -> bool:
+        # this is True if at least one client is not in a flood wait
+        self.readmit()
+        return bool(self.available)
+
+    def acquire(self) -> "Optional[TelegramClient]":
+        """
+        This returns the client which should do the next API call, or None if all of them are in a flood wait.
+        """
+        self.readmit()
+        if not self.available:
+            return None
+        name, client = next(iter(self.available.items()))
+        # it was used just now, so it goes to the end of the line
+        self.available.move_to_end(name)
+        return client
+
+    def flood(self, client: "TelegramClient", seconds: int) -> None:
+        # this is called when telegram gave the client a flood wait
+        name = client_name(client)
+        self.wait(name, seconds)
+        FLOOD_WAIT_SECONDS.inc(seconds, client=name)
+        if self.registry:
+            self.registry.put(name, seconds)
+
+    def next_deadline(self) -> "Optional[float]":
+        # this is the monotonic time the first flood wait ends, or None if there is none
+        self.readmit()
+        # outdated entries on top of the heap are dropped, so the top is the real next one
+        while self.deadlines and (
+            self.flood_wait.get(self.deadlines[0][1]) != self.deadlines[0][0]
+        ):
+            heapq.heappop(self.deadlines)
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def retry_after(self) -> int:
+        # the seconds until the first flood wait ends, rounded up so the caller doesn't come back too early
+        deadline = self.next_deadline()
+        if deadline is None:
+            # the clients are still connecting, that doesn't take long
+            return 1 if self.starting else 0
+        return math.ceil(deadline - time.monotonic())
+
+    def waits(self) -> "Dict[str, int]":
+        # the remaining seconds of every flood wait, this is used for logging
+        self.readmit()
+        now = time.monotonic()
+        return {
+            name: math.ceil(deadline - now)
+            for name, deadline in self.flood_wait.items()
+        }
@@ -1,90 +1,173 @@
 import asyncio
+import logging
 import sys
 import traceback
+from typing import TYPE_CHECKING
 
-from telethon import TelegramClient
+from telethon import TelegramClient, errors
 from aiohttp import web
 
 from api_keys import ALLOWED_KEYS
+from metrics import KEY_REQUESTS
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Tuple
 
 # this module is used to do some (for the time being quite intense) logging to a telegram channel
 
 LOG_ID = "https://t.me/joinchat/TilGN79"
 
+# the log messages aren't sent right away. They go into this queue, and send_logs sends them every LOG_INTERVAL
+# seconds in the background, so no request has to wait for telegram. Similar events are merged into one message
+LOG_INTERVAL = 60
+# this is how many messages send_logs sends at most per interval, so logging can't eat our flood budget
+LOG_MESSAGES = 5
+# and this is how many events can wait in the queue. If it is full, new events are dropped instead of waiting
+LOG_QUEUE_SIZE = 1000
+# telegram doesn't take longer messages than this
+MESSAGE_LENGTH = 4096
+
+# the events waiting to be sent. Each one is the kind of event, the username and the details
+log_queue: "asyncio.Queue[Tuple[str, str, str]]" = asyncio.Queue(LOG_QUEUE_SIZE)
+# this counts the events which were dropped because the queue was full, the next summary tells us about them
+dropped = 0
 
-async def log_call(
-    client: TelegramClient,
+
+def log_call(
     username="",
     rg_traceback="",
     fw_traceback="",
     all_clients_hit="",
     username_not_found="",
+    exception="",
 ) -> None:
-    # this is the base string, which will get appended based on the difference calls
-    string_to_send = ""
+    # this never blocks, the event is only put in the queue
+    global dropped
     if rg_traceback:
-        # this tracebacks is when the regex for the site fails in one case, which only happens when the username is
-        # invalid, or so I hope. This is to check this, if it triggers wrongly, we have to investigate further
-        string_to_send += (
-            "The excepted regex fail happened, with the username @"
-            + username
-            + " and the following traceback:\n```"
-            + rg_traceback
-            + "```"
-        )
+        event = ("regex", username, rg_traceback)
     elif fw_traceback:
-        # the floodwait from telegram is likely going to limit this API a bit, so it gets its own error
-        string_to_send += (
-            "A FloodWait happened!!! With the username @"
-            + username
-            + " and the following traceback:\n```"
-            + fw_traceback
-            + "```"
-        )
+        event = ("flood", username, fw_traceback)
     elif all_clients_hit:
-        # this is returned when all clients are hit with a FloodWait simultaneously
-        string_to_send += (
-            "All clients are hit with a floodwait. These are the current wait times:"
-            + all_clients_hit
-        )
+        event = ("all_clients", username, all_clients_hit)
     elif username_not_found:
-        # this happens when the api cant resolve the username
-        string_to_send += (
-            "This username was resolved by the API but doesn't exist. "
-            + username_not_found
-        )
-    # this gets send to a channel
-    await client.send_message(LOG_ID, string_to_send)
+        event = ("not_found", username, username_not_found)
+    else:
+        event = ("exception", username, exception)
+    try:
+        log_queue.put_nowait(event)
+    except asyncio.QueueFull:
+        dropped += 1
 
 
-# this counter is used to save how many calls are being done per API call
-counter = {}
+def summarize(events: "List[Tuple[str, str, str]]") -> "List[str]":
+    # events of the same kind with the same details end up in one message, which lists all the usernames
+    merged: "Dict[Tuple[str, str], Tuple[str, List[str]]]" = {}
+    for kind, username, details in events:
+        # the wait times change all the time, so these events are merged no matter what, and the last ones are shown
+        key = (kind, "" if kind == "all_clients" else details)
+        usernames = merged[key][1] if key in merged else []
+        usernames.append(username)
+        merged[key] = (details, usernames)
+    messages = []
+    for (kind, _), (details, usernames) in merged.items():
+        # the usernames are deduplicated, the order stays the same
+        names = ", ".join("@" + name for name in dict.fromkeys(usernames) if name)
+        times = f" {len(usernames)} times" if len(usernames) > 1 else ""
+        if kind == "regex":
+            # this tracebacks is when the regex for the site fails in one case, which only happens when the username is
+            # invalid, or so I hope. This is to check this, if it triggers wrongly, we have to investigate further
+            message = (
+                f"The excepted regex fail happened{times}, with the username {names} and the following "
+                f"traceback:\n```{details}```"
+            )
+        elif kind == "flood":
+            # the floodwait from telegram is likely going to limit this API a bit, so it gets its own error
+            message = f"A FloodWait happened!!! With the username {names} and the following traceback:\n```{details}```"
+        elif kind == "all_clients":
+            # this is returned when all clients are hit with a FloodWait simultaneously
+            message = (
+                f"All clients are hit with a floodwait{times}. These are the current wait times:"
+                + details
+            )
+        elif kind == "not_found":
+            # this happens when the api cant resolve the username
+            message = f"This username was resolved by the API but doesn't exist{times}. {details} ({names})"
+        else:
+            # the exception decorator already built the whole message
+            message = details + (f"\n\nThis happened{times}." if times else "")
+        messages.append(message[:MESSAGE_LENGTH])
+    if len(messages) > LOG_MESSAGES:
+        skipped = len(messages) - LOG_MESSAGES + 1
+        messages = messages[: LOG_MESSAGES - 1]
+        messages.append(f"And {skipped} more kinds of events, which I didn't send.")
+    return messages
+
+
+async def send_logs(client: TelegramClient) -> None:
+    # this runs forever in the background and is the only place which sends the log messages
+    global dropped
+    while True:
+        # we wait for the first event, and then give the others some time to show up, so they can be merged
+        events = [await log_queue.get()]
+        await asyncio.sleep(LOG_INTERVAL)
+        while not log_queue.empty():
+            events.append(log_queue.get_nowait())
+        messages = summarize(events)
+        if dropped:
+            messages.append(f"The log queue was full, {dropped} events were dropped.")
+            dropped = 0
+        for message in messages:
+            try:
+                # this gets send to a channel
+                await client.send_message(LOG_ID, message)
+            except errors.FloodWaitError as e:
+                # the rest of this batch is lost, we rather not log than wait with a full queue
+                logging.warning("The log client has to wait for %s seconds", e.seconds)
+                await asyncio.sleep(e.seconds)
+                break
+            except Exception:
+                # if telegram doesn't take the message, it ends up in our logfile instead
+                logging.exception("Sending a log message failed")
 
 
 async def increase_counter(api_key: str, call_type: str) -> None:
-    # here the name gets taken from the allowed keys dict
-    name = ALLOWED_KEYS[api_key]
-    # if its not present in the dict, add it here
-    if name not in counter:
-        counter[name] = {"cache": 0, "api_call": 0}
-    # increase the counter, so it happened once more
-    counter[name][call_type] += 1
+    # here the name gets taken from the allowed keys dict, the metrics count the calls per name and type
+    KEY_REQUESTS.inc(name=ALLOWED_KEYS[api_key], type=call_type)
 
 
 async def send_counter(client: TelegramClient) -> None:
-    # same logic as the cache save, which means each startup gets a message from this
+    # same logic as the cache save, which means each startup gets a message from this. The metrics only ever go up,
+    # so we remember what they were at the last message and send the difference
+    last: "Dict[Tuple[str, ...], float]" = {}
     while True:
+        # this sorts the new calls by the name of the api key
+        counter: "Dict[str, Dict[str, int]]" = {}
+        for (name, call_type), value in KEY_REQUESTS.values.items():
+            calls = counter.setdefault(
+                name,
+                {
+                    "cache": 0,
+                    "api_call": 0,
+                    "coalesced": 0,
+                    "not_found": 0,
+                    "rate_limited": 0,
+                },
+            )
+            calls[call_type] = int(value - last.get((name, call_type), 0))
+        last = dict(KEY_REQUESTS.values)
         # this is the base string, on that
         string_to_send = "This time, the following bots used these many calls:\n\n"
         # we append the counter per api key
         for name in counter:
-            string_to_send += f"• {name} -  Cache: {counter[name]['cache']}, API calls: {counter[name]['api_call']}\n"
+            string_to_send += (
+                f"• {name} -  Cache: {counter[name]['cache']}, API calls: {counter[name]['api_call']}, "
+                f"Coalesced: {counter[name]['coalesced']}, Not found: {counter[name]['not_found']}, "
+                f"Rate limited: {counter[name]['rate_limited']}\n"
+            )
         # nice bye here
         string_to_send += "\nSee you again in an hour :)"
         # sending it
         await client.send_message(LOG_ID, string_to_send)
-        # clearing the dict so we dont count twice
-        counter.clear()
         # and sleeping for an hour
         await asyncio.sleep(60 * 60)
 
@@ -100,35 +183,21 @@ def exception_decorator(func):
                 # if the error is an instance of the HTTP errors, this means I have raised them manually earlier, so
                 # no need to panic. they have their own log calls anyway.
                 return e
-            # this catches every exception. now we have to get the initiated client from the params
-            client = False
-            for arg in args:
-                # if the type of the unnamed args is a list and the first item in the list is a TelegramClient,
-                # we found the client \o/
-                if type(arg) == list:
-                    if type(arg[0]) == TelegramClient:
-                        client = arg[0]
-                        break
-            if not client:
-                # if args didn't yield a client, it could be in kwargs, so we check. This requires the clients list to
-                # always be passed as clients. If I mistype that at some place, I could break it, yay
-                if "clients" in kwargs:
-                    client = kwargs["clients"][0]
-                else:
-                    # if we don't have a client here, it doesn't exists, so we raise
-                    raise
-            # traceback.format_tb returns the usual python message about an exception, but as a
-            # list of strings rather than a single string, so we have to join them together.
-            tb_list = traceback.format_tb(sys.exc_info()[2])
-            tb_string = "".join(tb_list)
-            # now the string, telling the kind of error and where it happened
-            string_to_send = (
-                f"Oh no, an unexpected error happened, but at least I can tell you about it. The name is"
-                f" `{e.__repr__()}`, the traceback:\n```" + tb_string + "```"
-            )
-            # sending it
-            await client.send_message(LOG_ID, string_to_send)
+            report_exception(e)
             # and writing it to our logfile
             raise
 
     return wrap_func
+
+
+def report_exception(e: Exception) -> None:
+    # this is called in an except block, and tells us about the exception which is handled there
+    # traceback.format_tb returns the usual python message about an exception, but as a
+    # list of strings rather than a single string, so we have to join them together.
+    tb_list = traceback.format_tb(sys.exc_info()[2])
+    tb_string = "".join(tb_list)
+    # now the string, telling the kind of error and where it happened. It is sent in the background
+    log_call(
+        exception=f"Oh no, an unexpected error happened, but at least I can tell you about it. The name is"
+        f" `{e.__repr__()}`, the traceback:\n```" + tb_string + "```"
+    )
@@ -1,36 +1,49 @@
 import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
 from functools import partial
 
 from telethon import TelegramClient
-from aiohttp import web, ClientSession
-import ujson as json
+from aiohttp import web
 from typing import TypedDict, TYPE_CHECKING
 
+from cacheStore import SqliteStore, JsonStore, UsernameCache, read_json
 from checkURL import check_url
-from resolveUsername import endpoint
+from clientPool import ClientPool, FloodRegistry, start_client
+from resolveUsername import endpoint, batch_endpoint, chat_id_endpoint, refresh_popular
+from scrapeClient import ScrapeClient
 from api_keys import api_id, api_hash
-from log import send_counter
+from log import send_counter, send_logs
+from metrics import Gauge, metrics_endpoint, count_responses
 import textRoutes
 
 if TYPE_CHECKING:
-    from typing import Mapping
+    from typing import Dict, Optional
+
+    from cacheStore import CacheStore
 
 import logging
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", filename="log.log"
-)
 # this is the amounts of clients you want to initialize. The higher, the more you can migiate flood wait, because the
 # code will switch to the next
 CLIENTS = 1
-# x will be used to get up to client
-x = 0
-# This will be used to make requests to telegram's API. We throw the clients in a list
-clients: list[TelegramClient] = []
-# in this loop we add the unique clients to the dict
-while x != CLIENTS:
-    clients.append(TelegramClient("session_" + str(x), api_id, api_hash))
-    x += 1
+# this is the amount of processes which serve requests. Each one runs on its own core and gets its own share of the
+# clients, so you need at least as many clients as workers. Log in with one worker first, the workers can't ask for
+# your phone number
+WORKERS = 1
+# the log messages are sent by the first client. If this is True, a client of its own sends them instead, so logging
+# doesn't count against the flood limits of the clients doing the lookups. It has to be in the log chat as well
+LOG_CLIENT = False
+# this decides where the cache is kept on disk. "sqlite" writes every change to cache.sqlite3 shortly after it happens,
+# "json" is the old way of rewriting cache.json every hour
+CACHE_BACKEND = "sqlite"
+# this is how many entries the cache keeps in memory, and roughly how many bytes they may take. If it is full, the ones
+# which weren't asked for the longest time are dropped and read from the disk again when they are needed. 0 means there
+# is no limit. With the json backend, the file is kept in memory anyway, so this only helps with sqlite
+CACHE_LIMIT = 0
+CACHE_MEMORY_LIMIT = 0
 
 
 # This is the type hinted layout of the temp storage, so mypy can use this to do its type checking
@@ -40,72 +53,248 @@ class Username(TypedDict):
     chat_type: str
     first_name: str
     last_name: str
+    # the unix timestamp of the last time the website or the API confirmed this entry
+    verified: float
+    # the access hash of the chat for each session which got it from telegram, so the API can be asked about the chat
+    # without resolving the username first. Access hashes belong to an account, so another session can't use them
+    access_hashes: "Optional[Dict[str, int]]"
 
 
-# the cache is just this json file. With this and scraping the telegram website, we can do less requests to the API
-# if the website and our temp storage are the same, we dont need to renew it with an API call
-cache: "Mapping[str, Username]" = json.load(open("cache.json", "rb"))
-
-
-# this creates a usable session. You only want to do this once in order to benefit from collection pooling
-async def session_creator() -> ClientSession:
-    return ClientSession()
+# this creates a usable session. You only want to do this once in order to benefit from collection pooling. The
+# timeouts, connection limits and retries are set in scrapeClient.py
+async def session_creator() -> ScrapeClient:
+    return ScrapeClient()
 
 
-# this saves the temp storage dict to the json file every hour. if that breaks nothing important is lost
-async def save() -> None:
-    # the while loop takes care that the saving never stops :D
+# this compacts the store every hour. For the json store, this is when the file gets written. If that breaks, nothing
+# important is lost
+async def compact(store: "CacheStore") -> None:
+    # the while loop takes care that the compacting never stops :D
     while True:
-        # this opens the file for writing as a file
-        with open("cache.json", "w") as outfile:
-            # and here it gets dumped, with the indent of 4 and sorted keys, so its nice to look at
-            json.dump(cache, outfile, indent=4, sort_keys=True)
+        await store.compact()
         # and here this sleeps for an hour (60 minutes * 60 seconds
         await asyncio.sleep(60 * 60)
 
 
-# this gets the event loop, in order for us to register/call functions in it
-loop = asyncio.get_event_loop()
-# first, we have to create the session, so we can pass it on later. Remember, you only want one
-session = loop.run_until_complete(session_creator())
-
-# the app is the initiated web application
-app = web.Application()
-# here we add the router to each URL we want to support. every URL gets passed the check function first, which make
-# sure all expected parameters exists, and then makes sure the api_key is allowed, if it is present. Then it reroutes
-# the request to the route_to function, and passes on cache, client, and session. I wasn't able to directly
-# import it because of circular imports, and this is the reason I went with partial, maybe someone can improve this
-# later
-app.router.add_get(
-    "/resolveUsername",
-    partial(
-        check_url,
-        expected_parameters=["api_key", "username"],
-        route_to=endpoint,
-        clients=clients,
-        cache=cache,
-        session=session,
-    ),
-)
-
-# these two handlers are text only, they don't need the checker
-app.router.add_get("/", textRoutes.index)
-app.router.add_get("/api_doc", textRoutes.api_documentation)
-
-# the runner gets initiated
-runner = web.AppRunner(app)
-# and set up
-loop.run_until_complete(runner.setup())
-# this defines the site which is supposed to run
-site = web.TCPSite(runner, host="localhost", port=1234)
-# and here the site gets started
-loop.run_until_complete(site.start())
-# this connects the client to telegram
-for c_client in clients:
-    c_client.start()
-# this task sends a log for how many calls each api key did, every now and then (an hour right now
-loop.create_task(send_counter(clients[0]))
-# the save task gets created here
-loop.create_task(save())
-# and this is the final call which runs forever.
-loop.run_forever()
+# this loads the cache in the background, while the requests are already served
+async def load_cache(cache: UsernameCache, migrate: bool) -> None:
+    loaded = await cache.load()
+    # the first time the database is used, it takes over the entries from the old json file. The ones requests added in
+    # the meantime are newer
+    if migrate and not loaded and os.path.exists("cache.json"):
+        entries = await asyncio.get_running_loop().run_in_executor(
+            None, read_json, "cache.json"
+        )
+        for key, entry in entries.items():
+            if key not in cache:
+                cache[key] = entry
+
+
+# the log tasks need the log client. They start as soon as it is connected, no matter how the other clients are
+# doing, the log messages wait in the queue until then
+async def start_logging(
+    clients: ClientPool, log_client: TelegramClient, separate_log_client: bool
+) -> None:
+    if separate_log_client:
+        await start_client(log_client)
+    else:
+        await clients.wait_started(log_client)
+    # this task sends the log messages in the background
+    asyncio.create_task(send_logs(log_client))
+    # this task sends a log for how many calls each api key did, every now and then (an hour right now
+    asyncio.create_task(send_counter(log_client))
+
+
+def create_app(
+    clients: ClientPool,
+    cache: UsernameCache,
+    session: ScrapeClient,
+) -> web.Application:
+    # the app is the initiated web application. This is its own function so the benchmark can run the very same app
+    # with fake clients
+    app = web.Application(middlewares=[count_responses])
+    # here we add the router to each URL we want to support. every URL gets passed the check function first, which
+    # make sure all expected parameters exists, and then makes sure the api_key is allowed, if it is present. Then it
+    # reroutes the request to the route_to function, and passes on cache, client, and session. I wasn't able to
+    # directly import it because of circular imports, and this is the reason I went with partial, maybe someone can
+    # improve this later
+    app.router.add_get(
+        "/resolveUsername",
+        partial(
+            check_url,
+            expected_parameters=["api_key", "username"],
+            route_to=endpoint,
+            clients=clients,
+            cache=cache,
+            session=session,
+        ),
+    )
+    # this one resolves a chat id to the chat, as far as we have it in the cache
+    app.router.add_get(
+        "/resolveChatId",
+        partial(
+            check_url,
+            expected_parameters=["api_key", "chat_id"],
+            route_to=chat_id_endpoint,
+            clients=clients,
+            cache=cache,
+            session=session,
+        ),
+    )
+    # the batch version takes the usernames as a json list in the body, so it is a POST request
+    app.router.add_post(
+        "/resolveUsernames",
+        partial(
+            check_url,
+            expected_parameters=["api_key"],
+            route_to=batch_endpoint,
+            clients=clients,
+            cache=cache,
+            session=session,
+        ),
+    )
+
+    # these handlers are text only, they don't need the checker
+    app.router.add_get("/", textRoutes.index)
+    app.router.add_get("/api_doc", textRoutes.api_documentation)
+    # this tells a load balancer or a restart script if the clients are connected and the cache is loaded
+    app.router.add_get(
+        "/ready", partial(textRoutes.ready, clients=clients, cache=cache)
+    )
+    # this is for Prometheus. It doesn't need an api key, so make sure your reverse proxy doesn't pass it on
+    app.router.add_get("/metrics", metrics_endpoint)
+    return app
+
+
+def serve(worker: int) -> None:
+    # this runs one worker. With more than one, each of them only opens its own share of the sessions, so telethon
+    # never has a session open twice
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        filename="log.log",
+    )
+    # x will be used to get up to client
+    x = 0
+    # This will be used to make requests to telegram's API. We throw the clients in a list
+    client_list: list[TelegramClient] = []
+    # in this loop we add the unique clients to the dict
+    while x != CLIENTS:
+        if x % WORKERS == worker:
+            client_list.append(TelegramClient("session_" + str(x), api_id, api_hash))
+        x += 1
+    # the pool decides which client makes the next API call, and keeps track of their flood waits. With the sqlite
+    # backend, the waits are kept in the database as well, so a restarted worker knows about them
+    clients = ClientPool(
+        client_list,
+        FloodRegistry("cache.sqlite3") if CACHE_BACKEND == "sqlite" else None,
+        started=False,
+    )
+    # the log client belongs to the first worker, the others log with their first client
+    log_client = (
+        TelegramClient("session_log", api_id, api_hash)
+        if LOG_CLIENT and worker == 0
+        else clients[0]
+    )
+
+    store: "CacheStore"
+    if CACHE_BACKEND == "sqlite":
+        store = SqliteStore("cache.sqlite3")
+    else:
+        store = JsonStore("cache.json")
+
+    # the cache is loaded from the store once the server runs. With this and scraping the telegram website, we can do
+    # less requests to the API if the website and our temp storage are the same, we dont need to renew it with an API
+    # call. If there are other workers, we look in the store for what they added
+    cache = UsernameCache(
+        store,
+        shared=WORKERS > 1,
+        limit=CACHE_LIMIT,
+        memory_limit=CACHE_MEMORY_LIMIT,
+        lazy=True,
+    )
+
+    # these are asked for their value every time the metrics are scraped
+    Gauge("cache_entries", "Usernames in the cache.", lambda: len(cache))
+    Gauge(
+        "cache_bytes",
+        "Roughly how many bytes the entries in the cache take.",
+        lambda: cache.memory,
+    )
+    Gauge(
+        "flood_waited_clients",
+        "Clients which are waiting for a flood wait to end.",
+        lambda: len(clients.waits()),
+    )
+
+    # this gets the event loop, in order for us to register/call functions in it
+    loop = asyncio.get_event_loop()
+    # first, we have to create the session, so we can pass it on later. Remember, you only want one
+    session = loop.run_until_complete(session_creator())
+
+    app = create_app(clients, cache, session)
+    # the runner gets initiated
+    runner = web.AppRunner(app)
+    # and set up
+    loop.run_until_complete(runner.setup())
+    # this defines the site which is supposed to run. With more than one worker, all of them listen on the same port
+    # and the kernel spreads the connections over them
+    site = web.TCPSite(runner, host="localhost", port=1234, reuse_port=WORKERS > 1)
+    # and here the site gets started, so requests are answered from the first moment on
+    loop.run_until_complete(site.start())
+    # the cache is loaded and the clients connect in the background. Until they are done, misses are looked up in the
+    # database and requests which need the API get a 429
+    loop.create_task(
+        load_cache(cache, migrate=worker == 0 and CACHE_BACKEND == "sqlite")
+    )
+    loop.create_task(clients.start())
+    loop.create_task(start_logging(clients, log_client, LOG_CLIENT and worker == 0))
+    # this task keeps the entries of popular usernames fresh, so their requests don't have to wait for telegram
+    loop.create_task(refresh_popular(clients, cache, session))
+    # the compact task gets created here, one worker doing this is enough
+    if worker == 0:
+        loop.create_task(compact(store))
+    # and this is the final call which runs forever.
+    loop.run_forever()
+
+
+def main() -> None:
+    if WORKERS == 1:
+        serve(0)
+        return
+    # the workers have to share the cache, the json file can't do that. And every worker needs at least one client
+    if CACHE_BACKEND != "sqlite" or CLIENTS < WORKERS:
+        raise ValueError(
+            "More than one worker needs the sqlite backend and at least one client per worker"
+        )
+    # the database is created here once, so the workers don't race to do it
+    SqliteStore("cache.sqlite3").close()
+    FloodRegistry("cache.sqlite3")
+    workers = {}
+    for worker in range(WORKERS):
+        workers[worker] = multiprocessing.Process(target=serve, args=(worker,))
+        workers[worker].start()
+    try:
+        # if a worker dies, it is started again with the same sessions
+        while True:
+            multiprocessing.connection.wait(
+                [process.sentinel for process in workers.values()]
+            )
+            for worker, process in workers.items():
+                if not process.is_alive():
+                    logging.error(
+                        "Worker %s exited with %s, restarting it",
+                        worker,
+                        process.exitcode,
+                    )
+                    time.sleep(1)
+                    workers[worker] = multiprocessing.Process(
+                        target=serve, args=(worker,)
+                    )
+                    workers[worker].start()
+    finally:
+        for process in workers.values():
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
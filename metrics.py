@@ -0,0 +1,288 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+
+if TYPE_CHECKING:
+    from typing import Callable, Dict, Iterator, List, Tuple
+
+# this module keeps the numbers about what the API is doing. They are exposed on /metrics in the Prometheus text
+# format, and the hourly summary in the log channel is built from them as well. There is no dependency for this, the
+# format is simple enough
+
+PREFIX = "username_to_chat_"
+
+# every metric registers itself here, so render knows about it
+registry: "List[Metric]" = []
+
+
+def escape(value: str) -> str:
+    # label values have to escape these three
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: "Tuple[str, ...]", values: "Tuple[str, ...]") -> str:
+    if not names:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+        + "}"
+    )
+
+
+class Metric:
+    """
+    The base of all metrics. A metric has a name, a help text, and the names of its labels. Every combination of label
+    values gets its own value.
+    """
+
+    kind = ""
+
+    def __init__(
+        self, name: str, documentation: str, labels: "Tuple[str, ...]" = ()
+    ) -> None:
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labels = labels
+        registry.append(self)
+
+    def label_values(self, labels: "Dict[str, str]") -> "Tuple[str, ...]":
+        # the values are always in the order the labels were declared in
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> "Iterator[str]":
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labels: "Tuple[str, ...]" = ()
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.values: "Dict[Tuple[str, ...], float]" = {}
+        # a counter without labels is there from the start, so it shows up as 0 instead of not at all
+        if not labels:
+            self.values[()] = 0
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> "Iterator[str]":
+        for key, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+
+class Gauge(Metric):
+    """
+    A gauge which asks a function for its value every time it is rendered, so nothing has to keep it up to date.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, function: "Callable[[], float]"
+    ) -> None:
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self) -> "Iterator[str]":
+        yield f"{self.name} {self.function()}"
+
+
+class GaugeFamily(Metric):
+    """
+    The same as Gauge, but the function returns a value for every combination of label values.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: "Tuple[str, ...]",
+        function: "Callable[[], Dict[Tuple[str, ...], float]]",
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def samples(self) -> "Iterator[str]":
+        for key, value in self.function().items():
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+
+# these buckets go from a tenth of a millisecond for the cache up to ten seconds for a slow API call
+BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: "Tuple[str, ...]" = (),
+        buckets: "Tuple[float, ...]" = BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # per label values: the count of each bucket (not cumulative, the last one is +Inf), and the sum
+        self.values: "Dict[Tuple[str, ...], Tuple[List[int], List[float]]]" = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.label_values(labels)
+        if key not in self.values:
+            self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self.values[key]
+        # a value which is exactly on a bound belongs into that bucket, that's why this is bisect_left
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def timer(self, **labels: str) -> "Iterator[None]":
+        # this measures how long the with block takes, awaits included
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self) -> "Iterator[str]":
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = format_labels(self.labels + ("le",), key + (le,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {total[0]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+# the metrics themselves. The stages are fetch (getting the website, dns and connect are parts of it when a new
+# connection was needed), read (receiving the body, only without the streaming parser), parse (reading it, with the
+# streaming parser this includes receiving the body), queue (waiting for a slot for the lookup), cache (looking the
+# username up in the cache), api (the MTProto call) and encode (building the json response)
+STAGE_SECONDS = Histogram(
+    "stage_seconds", "How long each stage of a lookup takes.", ("stage",)
+)
+CACHE_RESULTS = Counter(
+    "cache_results_total",
+    "What the cache could do for a request: hit, stale (served and verified in the background), miss or not_found.",
+    ("outcome",),
+)
+CACHE_EVICTIONS = Counter(
+    "cache_evictions_total",
+    "Entries the cache dropped from memory because it was full. They are still in the store.",
+)
+COALESCED = Counter(
+    "coalesced_total", "Requests which waited for a lookup which was already running."
+)
+DEGRADED = Counter(
+    "degraded_total",
+    "Cache entries which were served stale because telegram couldn't be asked.",
+)
+HEDGED = Counter(
+    "hedged_total",
+    "Fetches of the website which were slow, so a second one was started.",
+)
+TIMEOUTS = Counter(
+    "timeouts_total",
+    "Usernames which couldn't be resolved before the deadline of their request.",
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total",
+    "New lookups which were turned away because the admission queue was full or the wait too long.",
+)
+BACKGROUND_FAILURES = Counter(
+    "background_failures_total",
+    "Lookups in the background which failed because the website or telegram didn't answer (in time), by error.",
+    ("error",),
+)
+REFRESHES = Counter(
+    "refreshes_total",
+    "Cache entries of popular usernames which were verified in the background before anyone asked for them.",
+)
+RESULTS = Counter(
+    "results_total",
+    "Resolved usernames by status code, every username of a batch counts.",
+    ("status",),
+)
+RESPONSES = Counter(
+    "http_responses_total",
+    "HTTP responses by path and status code.",
+    ("path", "status"),
+)
+FLOOD_WAIT_SECONDS = Counter(
+    "flood_wait_seconds_total",
+    "Seconds each client was told to wait by telegram.",
+    ("client",),
+)
+WEBSITE_RETRIES = Counter(
+    "website_retries_total",
+    "Requests to t.me which were tried again after a connection error, timeout or server error.",
+)
+KEY_REQUESTS = Counter(
+    "api_key_requests_total",
+    "Requests per api key and how they were answered.",
+    ("name", "type"),
+)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    # this is the version of the text format Prometheus expects
+    return web.Response(
+        body=render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+@web.middleware
+async def count_responses(request: web.Request, handler) -> web.StreamResponse:  # type: ignore[no-untyped-def]
+    # this counts every response by its status code, the errors from check_url included. Raised HTTP errors count
+    # as well
+    # the path is the one of the route, so scanners trying random URLs can't create endless label values
+    resource = request.match_info.route.resource
+    path = resource.canonical if resource else "other"
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        RESPONSES.inc(path=path, status=str(e.status))
+        raise
+    RESPONSES.inc(path=path, status=str(response.status))
+    return response
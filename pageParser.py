@@ -0,0 +1,375 @@
+import asyncio
+import codecs
+import html
+import re
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING
+
+# we only borrow the lookup tables from bs4 here, so the streaming parser resolves entities and groups tags exactly the
+# same way the BeautifulSoup fallback in resolveUsername does
+from aiohttp import ClientError
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+
+from scrapeClient import BODY_LIMIT, ResponseTooLargeError, read_text
+
+if TYPE_CHECKING:
+    from aiohttp import ClientResponse
+    from typing import Optional, Tuple, List, Set
+
+# these are the same regexes website() used to run over the whole page. They only match inside a line (or three lines
+# for the extra), which is what allows us to run them on the part of the page we already downloaded
+TITLE_REGEX = re.compile('<meta property="og:title" content="(.*)">')
+EXTRA_REGEX = re.compile(
+    '<div class="tgme_page_extra">\n {2}(.*)\n</div>|'
+    '<div class="tgme_page_extra">(.*)</div>'
+)
+# this is the numeric character reference html.parser accepts. A "&#" which isn't one of them makes it stop parsing
+CHARREF_REGEX = re.compile("&#(?:[0-9]+|[xX][0-9a-fA-F]+)[^0-9a-fA-F]")
+# the bio lives in this div, BeautifulSoup matches it if any of the space separated classes is this one
+DESCRIPTION_CLASS = "tgme_page_description"
+# how many bytes we read from the response at once. t.me pages are small, so this ends up being a handful of reads
+CHUNK_SIZE = 4096
+# once we have everything, the rest of the page is read in the background without looking at it, up to this many
+# bytes. That way the connection can be reused for the next request instead of being closed with unread data in it
+DRAIN_LIMIT = 64 * 1024
+
+# bs4 closes these tags right away, they can't have children. It types the table as optional, though it is always set
+EMPTY_ELEMENT_TAGS = HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS or set()
+# strings inside these tags are not plain NavigableStrings in bs4, so get_text() skips them
+STRING_CONTAINER_TAGS = set(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS)
+# whitespace only strings are squashed by bs4, unless they are inside one of these tags
+PRESERVE_WHITESPACE_TAGS = HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+
+class PageExtractor(HTMLParser):
+    """
+    This parser gets fed the t.me page piece by piece and pulls out the three things website() needs: the og:title, the
+    text of the description div (with <br> turned into \n, like get_text() does it) and the tgme_page_extra. It mimics
+    what BeautifulSoup does with the html.parser backend, without building a tree, and tells us once it knows all three
+    so we can stop downloading the rest of the page.
+    """
+
+    def __init__(self) -> None:
+        # bs4 handles the character references itself, so we do as well
+        super().__init__(convert_charrefs=False)
+        # the complete page we got so far, the regexes run over this
+        self.page = ""
+        # everything in front of this position was already handed to the html parser
+        self.parsed_position = 0
+        # html.parser gets stuck at a broken "&#" until it gets more data. Fed the whole page at once, like
+        # BeautifulSoup does it, it never gets more, so the rest of the page ends up as text. Once this happens we stop
+        # feeding it until the page is complete, so the result stays the same. It is either "skipped", when the "&#"
+        # was turned into text already, or "waiting", when it still waits for a semicolon behind it
+        self.stuck: "Optional[str]" = None
+        # everything in front of these positions was already searched by the regexes
+        self.title_position = 0
+        self.extra_position = 0
+        # these hold the results once they are certain. None means we don't know (yet)
+        self.title: "Optional[str]" = None
+        self.extra: "Optional[str]" = None
+        # the extra can be missing from a page, this tells us that we are sure about it either way
+        self.extra_done = False
+        self.bio_parts: "List[str]" = []
+        self.bio_done = False
+        # the open tags of the whole document, this is needed to close them the same way bs4 does
+        self.stack: "List[str]" = []
+        self.open_tags: "dict[str, int]" = {}
+        # the positions in the stack of the tags which change how strings are treated
+        self.preserve_stack: "List[int]" = []
+        self.container_stack: "List[int]" = []
+        # empty element tags we already closed ourselves, so a later </br> is ignored
+        self.already_closed: "List[str]" = []
+        # the string bs4 would collect until the next tag
+        self.current_data: "List[str]" = []
+        # the positions of the first body and the description in the stack. bs4 only looks into the first body
+        self.body_position: "Optional[int]" = None
+        self.body_seen = False
+        self.description_position: "Optional[int]" = None
+
+    @property
+    def done(self) -> bool:
+        # this is True once all three parts are known, so the rest of the page doesn't matter anymore
+        return self.title is not None and self.extra_done and self.bio_done
+
+    def feed_text(self, text: str) -> None:
+        # the text is kept for the two regexes and handed to the html parser for the bio. The html parser only gets
+        # complete lines, because broken character references are handled differently if they are cut off at the end
+        # of a chunk, and a newline never is part of one
+        self.page += text
+        end = self.page.rfind("\n") + 1
+        if not self.bio_done and not self.stuck and end > self.parsed_position:
+            self.feed(self.page[self.parsed_position : end])
+            self.parsed_position = end
+            # this is the case where html.parser waits for a semicolon behind the broken "&#"
+            if (
+                not self.stuck
+                and self.rawdata.startswith("&#")
+                and not self.cdata_elem
+                and not CHARREF_REGEX.match(self.rawdata)
+            ):
+                self.stuck = "waiting"
+        self._search(final=False)
+
+    def finish(self) -> None:
+        # this is called when the page is fully downloaded. Everything which is still open now gets settled
+        if not self.bio_done:
+            if self.stuck == "skipped":
+                # it already skipped the "&#" and stopped, like it does with the whole page. feed() would make it go
+                # on, so the rest is only added to its buffer and close() takes care of it
+                self.rawdata += self.page[self.parsed_position :]
+            else:
+                # if it still waits at the "&#", the whole page decides if it is skipped, same as with BeautifulSoup
+                self.feed(self.page[self.parsed_position :])
+            self.close()
+            self._end_data()
+            self.bio_done = True
+        self._search(final=True)
+
+    def result(self) -> "Tuple[str, str, Optional[str]]":
+        """
+        This returns the names, bio and extra of the page. Extra is None if the regex didn't find it. The errors are
+        the same ones the BeautifulSoup version would raise for a broken page.
+        """
+        if not self.body_seen:
+            # BeautifulSoup doesn't find a body in this case, and .find on None fails
+            raise AttributeError("'NoneType' object has no attribute 'find'")
+        if self.title is None:
+            # this is the same error re.findall(...)[0] raises
+            raise IndexError("list index out of range")
+        return html.unescape(self.title), "".join(self.bio_parts), self.extra
+
+    def _search(self, final: bool) -> None:
+        # the regexes only run over complete lines, except when the page is finished
+        end = len(self.page) if final else self.page.rfind("\n") + 1
+        if self.title is None:
+            match = TITLE_REGEX.search(self.page, self.title_position, end)
+            if match:
+                self.title = match.group(1)
+            elif not final:
+                # the title is within one line, so nothing in front of end can match later on
+                self.title_position = end
+        if not self.extra_done:
+            match = EXTRA_REGEX.search(self.page, self.extra_position, end)
+            # the first regex spans three lines, so we need two more full lines behind the match to be sure it wasn't
+            # preferred at this position
+            if match and (final or self.page.count("\n", match.start(), end) >= 3):
+                self.extra = match.group(1) or match.group(2) or ""
+                self.extra_done = True
+            elif final:
+                # the page doesn't have an extra, that's the RegexFailedError case
+                self.extra_done = True
+            elif not match and end:
+                # a match could still start in the last two lines, everything in front of them is settled
+                position = end
+                for _ in range(2):
+                    position = (
+                        self.page.rfind("\n", self.extra_position, position - 1) + 1
+                    )
+                    if not position:
+                        break
+                self.extra_position = max(self.extra_position, position)
+
+    def _end_data(self) -> None:
+        # this is what bs4's endData does: the collected data becomes one string in the tree
+        if not self.current_data:
+            return
+        data = "".join(self.current_data)
+        self.current_data = []
+        if not self.preserve_stack and all(char in ASCII_SPACES for char in data):
+            data = "\n" if "\n" in data else " "
+        # only plain strings inside the description end up in get_text()
+        if self.description_position is not None and not self.container_stack:
+            self.bio_parts.append(data)
+
+    def _push(self, tag: str) -> None:
+        position = len(self.stack)
+        self.stack.append(tag)
+        self.open_tags[tag] = self.open_tags.get(tag, 0) + 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_stack.append(position)
+        if tag in STRING_CONTAINER_TAGS:
+            self.container_stack.append(position)
+
+    def _pop(self) -> None:
+        tag = self.stack.pop()
+        position = len(self.stack)
+        self.open_tags[tag] -= 1
+        if self.preserve_stack and self.preserve_stack[-1] == position:
+            self.preserve_stack.pop()
+        if self.container_stack and self.container_stack[-1] == position:
+            self.container_stack.pop()
+        if position == self.description_position:
+            # the description is closed, so the bio is complete
+            self.description_position = None
+            self.bio_done = True
+        if position == self.body_position:
+            # no description can show up in the body anymore
+            self.body_position = None
+            if self.description_position is None:
+                self.bio_done = True
+
+    def _pop_to_tag(self, tag: str) -> None:
+        # same as bs4's _popToTag, it closes every tag up to the most recent one with this name, if there is one
+        while self.stack and self.open_tags.get(tag):
+            if self.stack[-1] == tag:
+                self._pop()
+                break
+            self._pop()
+
+    def handle_starttag(
+        self, tag: str, attrs: "List[Tuple[str, Optional[str]]]"
+    ) -> None:
+        self._start(tag, attrs, handle_empty_element=True)
+
+    def handle_startendtag(
+        self, tag: str, attrs: "List[Tuple[str, Optional[str]]]"
+    ) -> None:
+        self._start(tag, attrs, handle_empty_element=False)
+        self._end(tag, check_already_closed=False)
+
+    def _start(
+        self,
+        tag: str,
+        attrs: "List[Tuple[str, Optional[str]]]",
+        handle_empty_element: bool,
+    ) -> None:
+        self._end_data()
+        if self.bio_done:
+            return
+        self._push(tag)
+        if tag == "body" and not self.body_seen:
+            self.body_seen = True
+            self.body_position = len(self.stack) - 1
+        elif (
+            tag == "div"
+            and self.body_position is not None
+            and self.description_position is None
+        ):
+            # duplicated attributes are replaced by the last one in bs4, a dict does the same
+            classes = dict(attrs).get("class")
+            if classes is not None and (
+                DESCRIPTION_CLASS in classes.split() or classes == DESCRIPTION_CLASS
+            ):
+                self.description_position = len(self.stack) - 1
+        elif tag == "br" and self.description_position is not None:
+            # this is the replacement get_text() does
+            self.bio_parts.append("\n")
+        if tag in EMPTY_ELEMENT_TAGS and handle_empty_element:
+            self._end(tag, check_already_closed=False)
+            self.already_closed.append(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        self._end(tag, check_already_closed=True)
+
+    def _end(self, tag: str, check_already_closed: bool) -> None:
+        if check_already_closed and tag in self.already_closed:
+            self.already_closed.remove(tag)
+            return
+        self._end_data()
+        self._pop_to_tag(tag)
+
+    def handle_data(self, data: str) -> None:
+        # outside of script and style, "&#" only shows up as data when html.parser skips a broken reference, and it
+        # stops parsing right after that
+        if data == "&#" and not self.cdata_elem and not self.stuck:
+            self.stuck = "skipped"
+        self.current_data.append(data)
+
+    def handle_charref(self, name: str) -> None:
+        # this is a copy of what bs4 does with numeric references, including the broken ones without a semicolon
+        base = 10
+        regex = r"^([0-9]+)(.*)"
+        if name.startswith("x") or name.startswith("X"):
+            name = name[1:]
+            base = 16
+            regex = r"^([0-9a-f]+)(.*)"
+        number: "Optional[int]" = None
+        extra_data = ""
+        try:
+            number = int(name, base)
+        except ValueError:
+            match = re.search(regex, name)
+            if match is not None:
+                number = int(match.group(1), base)
+                extra_data = match.group(2)
+        if number is None:
+            self.handle_data(name)
+        else:
+            self.handle_data(UnicodeDammit.numeric_character_reference(number)[0])
+            self.handle_data(extra_data)
+
+    def handle_entityref(self, name: str) -> None:
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else "&" + name)
+
+    # these are not plain strings for bs4, but they still end the string in front of them
+    def handle_comment(self, data: str) -> None:
+        self._end_data()
+
+    def handle_decl(self, decl: str) -> None:
+        self._end_data()
+
+    def unknown_decl(self, data: str) -> None:
+        self._end_data()
+
+    def handle_pi(self, data: str) -> None:
+        self._end_data()
+
+
+# these are the tasks reading the rest of a page in the background, the reference keeps them from being garbage
+# collected
+draining: "Set[asyncio.Task]" = set()
+
+
+async def drain(response: "ClientResponse") -> None:
+    # this throws away the rest of the body and gives the connection back. If the rest is bigger than the limit, or the
+    # connection breaks, we give up and aiohttp closes the connection instead
+    try:
+        drained = 0
+        while drained <= DRAIN_LIMIT:
+            chunk = await response.content.readany()
+            if not chunk:
+                break
+            drained += len(chunk)
+    except (ClientError, asyncio.TimeoutError):
+        pass
+    finally:
+        response.release()
+
+
+async def parse_response(
+    response: "ClientResponse", body_limit: int = BODY_LIMIT
+) -> "Tuple[str, str, Optional[str]]":
+    """
+    This reads the t.me page from the response while it comes in and stops as soon as names, bio and extra are known.
+    The response is released in here. If we stop early, the rest of the page is read in the background, so the
+    connection can be reused. A page bigger than body_limit raises ResponseTooLargeError.
+    """
+    extractor = PageExtractor()
+    try:
+        if not response.charset:
+            # without a charset in the header we can't decode while reading, so the page is read as a whole
+            extractor.feed_text(await read_text(response, body_limit))
+        else:
+            # the incremental decoder takes care of characters which are split between two chunks
+            decoder = codecs.getincrementaldecoder(response.charset)(errors="strict")
+            read = 0
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                read += len(chunk)
+                if read > body_limit:
+                    raise ResponseTooLargeError
+                extractor.feed_text(decoder.decode(chunk))
+                if extractor.done:
+                    task = asyncio.create_task(drain(response))
+                    draining.add(task)
+                    task.add_done_callback(draining.discard)
+                    return extractor.result()
+            extractor.feed_text(decoder.decode(b"", final=True))
+    except BaseException:
+        response.release()
+        raise
+    response.release()
+    extractor.finish()
+    return extractor.result()
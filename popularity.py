@@ -0,0 +1,51 @@
+import heapq
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, List
+
+# this module keeps track of how often each username is asked for, so the refresher in resolveUsername knows which
+# entries are worth verifying before anyone asks for them again
+
+# every username which is asked for counts once. Every DECAY_INTERVAL seconds, all counts are halved, so a username
+# which was popular yesterday but isn't anymore drops out after a while
+DECAY_INTERVAL = 60 * 10
+# counts below this after halving are forgotten
+FORGET_BELOW = 0.5
+# and this is how many usernames we track at most. Once it is full, new usernames are only tracked after the next decay
+# made room, so random usernames can't fill up the memory
+TRACK_LIMIT = 100000
+
+
+class Popularity:
+    """
+    This is a counter per username which decays over time. Counting is a dict update, so it can be done for every
+    request.
+    """
+
+    def __init__(self, limit: int = TRACK_LIMIT) -> None:
+        self.limit = limit
+        self.counts: "Dict[str, float]" = {}
+
+    def hit(self, key: str) -> None:
+        count = self.counts.get(key)
+        if count is not None:
+            self.counts[key] = count + 1
+        elif len(self.counts) < self.limit:
+            self.counts[key] = 1
+
+    def decay(self) -> None:
+        # this is called every DECAY_INTERVAL seconds
+        self.counts = {
+            key: count / 2
+            for key, count in self.counts.items()
+            if count / 2 >= FORGET_BELOW
+        }
+
+    def hottest(self, amount: int) -> "List[str]":
+        # the usernames which were asked for the most lately, the most popular one first
+        return heapq.nlargest(amount, self.counts, key=self.counts.__getitem__)
+
+
+# the counts of this process
+popularity = Popularity()
@@ -0,0 +1,107 @@
+import math
+import time
+from typing import TYPE_CHECKING
+
+from api_keys import ALLOWED_KEYS, DEFAULT_LIMITS, KEY_LIMITS
+from metrics import GaugeFamily
+
+if TYPE_CHECKING:
+    from typing import Dict, Mapping, Optional, Tuple
+
+# this module keeps the rate limits of the api keys. Every key has a token bucket per budget, "cache" for the usernames
+# we answer from the cache and "upstream" for the ones the website or the API has to be asked about. The limits are set
+# in api_keys.py
+
+# a bucket with a rate of 0 is a fixed quota, it never gets new tokens. A key which used it up is told to come back
+# after this many seconds
+NO_REFILL_RETRY = 60 * 60 * 24
+
+
+class TokenBucket:
+    """
+    A bucket holds up to burst tokens and gets rate tokens per second. Every username takes one, if there is none left,
+    the key has to wait.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def level(self) -> float:
+        # the tokens are only added when someone looks, for the time since the last look
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self) -> bool:
+        if self.level() < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self) -> int:
+        # the seconds until the next token is there, rounded up so the caller doesn't come back too early
+        if self.rate <= 0:
+            return NO_REFILL_RETRY
+        return max(1, math.ceil((1 - self.level()) / self.rate))
+
+
+# the buckets, keyed on the api key and the budget. They are created the first time a key uses them
+buckets: "Dict[Tuple[str, str], TokenBucket]" = {}
+
+
+def limits(api_key: str) -> "Mapping[str, Tuple[float, float]]":
+    return KEY_LIMITS.get(api_key, DEFAULT_LIMITS)
+
+
+def bucket(api_key: str, budget: str) -> "Optional[TokenBucket]":
+    # this returns None if the budget of the key isn't limited
+    if (api_key, budget) not in buckets:
+        if budget not in limits(api_key):
+            return None
+        buckets[(api_key, budget)] = TokenBucket(*limits(api_key)[budget])
+    return buckets[(api_key, budget)]
+
+
+def take(api_key: str, budget: str) -> int:
+    """
+    This takes a token for one username out of the budget of the key. It returns 0 if there was one, otherwise the
+    seconds until there is one again.
+    """
+    token_bucket = bucket(api_key, budget)
+    if token_bucket is None or token_bucket.take():
+        return 0
+    return token_bucket.retry_after()
+
+
+def exhausted(api_key: str) -> int:
+    """
+    This returns the seconds until the key can do anything again, if all of its budgets are empty, and 0 otherwise. It
+    doesn't take a token, we don't know yet which budget the request needs.
+    """
+    waits = []
+    for budget in ("cache", "upstream"):
+        token_bucket = bucket(api_key, budget)
+        if token_bucket is None or token_bucket.level() >= 1:
+            return 0
+        waits.append(token_bucket.retry_after())
+    return min(waits)
+
+
+def levels() -> "Dict[Tuple[str, ...], float]":
+    # the tokens left in every bucket, for the metrics. The keys are shown by their name, the key itself is a secret
+    return {
+        (ALLOWED_KEYS.get(api_key, "unknown"), budget): token_bucket.level()
+        for (api_key, budget), token_bucket in buckets.items()
+    }
+
+
+GaugeFamily(
+    "rate_limit_tokens",
+    "Tokens left in the rate limit bucket of each api key and budget.",
+    ("name", "budget"),
+    levels,
+)
@@ -1,35 +1,149 @@
+import hashlib
 import html
 import re
 import traceback
 from typing import Generator, TypedDict, TYPE_CHECKING
 import sys
+import time
 import asyncio
+from collections import deque
 
-from aiohttp import web, web_response
+from aiohttp import web, ClientError
+import ujson as json
 from bs4 import BeautifulSoup
 from bs4.element import Tag, NavigableString
 from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.contacts import ResolveUsernameRequest
 from telethon.tl.functions.users import GetFullUserRequest
+from telethon.tl.types import InputChannel, InputUser, PeerUser
 from telethon import errors
 
 # these calls are temporarily to monitor the behaviour of the api
-from log import log_call, exception_decorator, increase_counter
+from log import log_call, exception_decorator, increase_counter, report_exception
+from metrics import STAGE_SECONDS, CACHE_RESULTS, COALESCED, RESULTS, WEBSITE_RETRIES
+from metrics import REFRESHES, DEGRADED, HEDGED, TIMEOUTS, ADMISSION_REJECTED
+from metrics import BACKGROUND_FAILURES
+from admission import admission, LOOKUPS_PER_CLIENT
+from popularity import popularity, DECAY_INTERVAL
+from rateLimit import take
+from scrapeClient import read_text, ResponseTooLargeError
+from cacheStore import bot_api_id, UsernameCache
+from clientPool import client_name
+from pageParser import parse_response
 
 if TYPE_CHECKING:
-    from aiohttp import ClientSession
     from telethon import TelegramClient
-    from typing import Tuple, Union, Literal, MutableMapping, Mapping
+    from clientPool import ClientPool
+    from scrapeClient import ScrapeClient
+    from cacheStore import CacheEntry
+    from typing import Tuple, Union, Literal, MutableMapping, Mapping, Optional, Dict
+    from typing import Callable, Coroutine, Any
 
     from main import Username
 
-# this is a dictionary which will hold clients which are in a floodwait, so we can use other ones
-flood_wait: "MutableMapping[str, Union[bool, int]]" = {}
+    # this is what a lookup ends with: the status code, and either the chat (for 200) or the error response
+    LookupResult = Tuple[int, Union[Username, dict]]
+
+# these are the lookups which are running right now, keyed on the lowercased username. Another request for the same
+# username waits for the running one, so we don't scrape the website or call the API twice for one answer
+in_flight: "MutableMapping[str, asyncio.Future[LookupResult]]" = {}
+# and the monotonic time each of them is cancelled at
+lookup_deadlines: "Dict[str, float]" = {}
 
 # usernames which are banned on iOS devices but actual fine chats. the website might not work for them, so I hardcode
 # them here when I encounter them and do not try the website for them later on. I have to map the names to their chat
 # type because otherwise we get the type from the website
 COPYRIGHT_USERNAMES: "Mapping[str, str]" = {"utubebot": "private"}
 
+# this is where the website of a username lives, the username is appended. The benchmark points this to its own server
+WEBSITE_URL = "https://t.me/"
+
+# the website is read with the streaming parser from pageParser, which stops reading once it found everything and
+# doesn't build a whole tree. If it ever misbehaves, setting this to False switches back to BeautifulSoup
+STREAMING_PARSER = True
+
+# this is the maximum amount of usernames which can be resolved with one resolveUsernames request
+BATCH_LIMIT = 500
+# and this is how many of them are resolved at the same time
+BATCH_CONCURRENCY = 20
+
+# a cache entry which was verified (by the website or the API) less than this many seconds ago is served without
+# looking at the website at all
+FRESH_FOR = 60 * 10
+# older entries are still served right away, and a lookup in the background verifies them for the next request. Only
+# entries older than this are verified before we answer
+STALE_FOR = 60 * 60 * 24
+
+# the refresher looks at the REFRESH_COUNT most popular usernames every REFRESH_INTERVAL seconds, and verifies the ones
+# which were verified more than REFRESH_AFTER seconds ago. That is less than FRESH_FOR, so their requests never have to
+# wait for the website or the API
+REFRESH_INTERVAL = 60
+REFRESH_COUNT = 100
+REFRESH_AFTER = FRESH_FOR / 2
+# and these are the seconds between two refreshes, so the refresher doesn't use up the flood budget the requests need
+REFRESH_PAUSE = 0.5
+
+# if telegram can't be asked, because all clients are in a flood wait or the website doesn't work, a cached entry is
+# served anyway, no matter how old it is. The response has stale set to true then. Switch this off to get the 429 or
+# the error instead
+SERVE_STALE = True
+# resolve returns this status if it served such an entry. It never leaves the API, the endpoints answer with 200
+STALE_STATUS = 203
+
+# every request is answered within this many seconds. A request can ask for less with the timeout parameter. The
+# lookups are shared between requests, so they always get the whole time, a request with less only stops waiting
+DEADLINE = 10
+# a request spends a moment before its lookup starts. If its deadline is only that much before the one of the lookup, it
+# just waits for the lookup, which saves a timer per request
+DEADLINE_SLACK = 0.1
+
+# if a fetch of the website takes longer than HEDGE_QUANTILE of the recent fetches, a second one is started, and
+# whichever is done first is used. This needs HEDGE_SAMPLES fetches to know what is slow, the last HEDGE_WINDOW ones
+# count
+HEDGE = True
+HEDGE_QUANTILE = 0.95
+HEDGE_SAMPLES = 100
+HEDGE_WINDOW = 1000
+
+# a username which isn't in the cache is resolved with the API right away, which tells us what kind of chat it is. If
+# this is False, the website is asked first, which costs nothing from the flood budget if the username doesn't exist
+RESOLVE_MISSES = True
+
+# telegram answers with one of these if the access hash we stored for a chat doesn't work anymore, then the username is
+# resolved again
+STALE_PEER_ERRORS = (
+    errors.UserIdInvalidError,
+    errors.ChannelInvalidError,
+    errors.ChannelPrivateError,
+    errors.PeerIdInvalidError,
+)
+
+# responses of the batch endpoint with at least this many bytes are compressed with gzip or deflate, if the caller
+# accepts it. Smaller ones don't get much smaller
+COMPRESS_AFTER = 1024
+
+# usernames which don't exist are remembered for this many seconds, so asking for them again costs neither the website
+# nor the API. Someone could take the username in the meantime, so this shouldn't be too long
+NOT_FOUND_FOR = 60 * 10
+# and this is how many of them we remember at most, the oldest ones are forgotten first
+NOT_FOUND_LIMIT = 100000
+
+# this is what telegram allows as a username: it starts with a letter, has letters, digits and single underscores in
+# the middle and doesn't end with an underscore. Anything else can't exist, so we don't have to ask anyone about it.
+# Most usernames have at least five characters, but some of telegram's own, like @gif, only have three
+USERNAME_PATTERN = re.compile(r"[a-z](?:_?[a-z0-9])+", re.IGNORECASE)
+USERNAME_LENGTH = range(3, 33)
+
+# the seconds the last fetches of the website took, and after how many seconds a fetch gets a second one. That is
+# calculated again every HEDGE_SAMPLES fetches
+fetch_times: "deque[float]" = deque(maxlen=HEDGE_WINDOW)
+fetches = 0
+hedge_after: "Optional[float]" = None
+
+# these are the usernames which don't exist, keyed on the lowercased username, mapped to the monotonic time until which
+# we believe it. A new entry always expires last, so the dict is sorted by expiry as well
+not_found: "Dict[str, float]" = {}
+
 
 class RegexFailedError(Exception):
     # this custom error class is just used to pass the expected regex fail when an username is invalid to the higher
@@ -37,6 +151,54 @@ class RegexFailedError(Exception):
     pass
 
 
+class WebsiteUnavailableError(Exception):
+    # this is raised when the website answers with anything but a 200, for server errors even after the retries. The
+    # page says nothing about the username then, so it mustn't be mistaken for one which doesn't exist
+    pass
+
+
+# these are the ways the website can fail us
+WEBSITE_ERRORS = (
+    ClientError,
+    asyncio.TimeoutError,
+    ResponseTooLargeError,
+    WebsiteUnavailableError,
+)
+
+
+def valid_username(user_name: str) -> bool:
+    # this checks the syntax only, a valid username still doesn't have to exist
+    return (
+        len(user_name) in USERNAME_LENGTH
+        and USERNAME_PATTERN.fullmatch(user_name) is not None
+    )
+
+
+def remember_not_found(key: str) -> None:
+    # the entry is moved to the end, since it expires last now
+    not_found.pop(key, None)
+    now = time.monotonic()
+    not_found[key] = now + NOT_FOUND_FOR
+    # expired entries are at the front, so we drop them from there, and the oldest ones if we have too many. Only the
+    # first entry is looked at each time, this runs for every username which doesn't exist
+    while not_found:
+        old_key = next(iter(not_found))
+        if not_found[old_key] > now and len(not_found) <= NOT_FOUND_LIMIT:
+            break
+        del not_found[old_key]
+
+
+def is_not_found(key: str) -> bool:
+    # this is True if the username didn't exist the last time we asked, and that wasn't too long ago
+    expires = not_found.get(key)
+    if expires is None:
+        return False
+    if expires > time.monotonic():
+        return True
+    del not_found[key]
+    return False
+
+
 def get_text(tag: "Tag") -> str:
     """
     This function only replaces <br> tags with \n right now. If more issues with the website bio vs API bio show up,
@@ -58,53 +220,129 @@ def get_text(tag: "Tag") -> str:
     return "".join(_get_text(tag))
 
 
-async def website(username: str, session: "ClientSession") -> "Tuple[str, str, str]":
+def parse_page(html_string: str) -> "Tuple[str, str, Optional[str]]":
+    """
+    This is the BeautifulSoup way of parsing the website. It is only used if STREAMING_PARSER is switched off.
+    """
+    # the next lines take care of the biography, if it exists. I have to use BS4 to parse its content properly
+    parsed_html = BeautifulSoup(html_string, features="html.parser")
+    bio_div = parsed_html.body.find("div", attrs={"class": "tgme_page_description"})
+    if bio_div:
+        bio = get_text(bio_div)
+    else:
+        bio = ""
+    # this gets the name (set together from first_name + " " + last_name or just the title) from the chat
+    names = html.unescape(
+        re.findall('<meta property="og:title" content="(.*)">', html_string)[0]
+    )
+    # this is used to determine the chat type. I am pretty sure I had an example where the first regex was necessary
+    # , though I am unable to find it right now. The second one is the usual one though.
+    result = re.findall(
+        '<div class="tgme_page_extra">\n {2}(.*)\n</div>|'
+        '<div class="tgme_page_extra">(.*)</div>',
+        html_string,
+    )
+    # this sets the extra variable to the result, depending on which regex triggered it
+    if not result:
+        return names, bio, None
+    if result[0][0]:
+        return names, bio, result[0][0]
+    return names, bio, result[0][1]
+
+
+def record_fetch(seconds: float) -> None:
+    global fetches, hedge_after
+    fetch_times.append(seconds)
+    fetches += 1
+    if fetches % HEDGE_SAMPLES == 0:
+        hedge_after = sorted(fetch_times)[int(len(fetch_times) * HEDGE_QUANTILE)]
+
+
+async def website(
+    username: str, session: "ScrapeClient", deadline: float
+) -> "Tuple[str, str, str]":
+    """
+    This returns what the website says about the username. If the fetch is slow, a second one is started, and the first
+    one which succeeds is used. The lookup is cancelled at its deadline, so this only needs the monotonic deadline to
+    know if a second fetch could still be done in time.
+    """
+    if not HEDGE or hedge_after is None or deadline - time.monotonic() <= hedge_after:
+        # the fetch runs in this task, a task of its own costs more than the rest of the request
+        return await scrape(username, session)
+    tasks = {asyncio.ensure_future(scrape(username, session))}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            HEDGED.inc()
+            tasks.add(asyncio.ensure_future(scrape(username, session)))
+        while True:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            # if both failed, the error of the last one is raised
+            if not tasks:
+                return done.pop().result()
+    finally:
+        # the one which is still running isn't needed anymore
+        for task in tasks:
+            task.cancel()
+
+
+async def scrape(username: str, session: "ScrapeClient") -> "Tuple[str, str, str]":
     """
     This function parses the website and returns the three information which one can get from it
     """
+    start = time.monotonic()
     # this sets together the url and "awaits" the result
     # Reminder: If we ever get limited from telegram to call this website, we should deal with this here
-    async with session.get("https://t.me/" + username) as response:
-        # the whole website is put in one string here for further processing
-        html_string = await response.text()
-        # the next lines take care of the biography, if it exists. I have to use BS4 to parse its content properly
-        parsed_html = BeautifulSoup(html_string, features="html.parser")
-        bio_div = parsed_html.body.find("div", attrs={"class": "tgme_page_description"})
-        if bio_div:
-            bio = get_text(bio_div)
-        else:
-            bio = ""
-        # this gets the name (set together from first_name + " " + last_name or just the title) from the chat
-        names = html.unescape(
-            re.findall('<meta property="og:title" content="(.*)">', html_string)[0]
-        )
-        # this is used to determine the chat type. I am pretty sure I had an example where the first regex was necessary
-        # , though I am unable to find it right now. The second one is the usual one though.
-        result = re.findall(
-            '<div class="tgme_page_extra">\n {2}(.*)\n</div>|'
-            '<div class="tgme_page_extra">(.*)</div>',
-            html_string,
-        )
-        # this sets the extra variable to the result, depending on which regex triggered it
-        # if the regex fails, the username doesn't exists, or at least I hope so. This is also closely monitored for now
-        try:
-            if result[0][0]:
-                extra = result[0][0]
-            else:
-                extra = result[0][1]
-        except IndexError:
-            # this is a bit of a hacky way to tell the code later that the username is invalid
-            raise RegexFailedError
-        # now we can determine the type depending on the extra. its going to be the username for private chats,
-        # the members count for channels, the members count + online members for supergroups.
-        if extra.startswith("@"):
-            chat_type = "private"
-        elif "online" in extra:
-            chat_type = "supergroup"
+    with STAGE_SECONDS.timer(stage="fetch"):
+        response, timing = await session.get(WEBSITE_URL + username)
+    # a reused connection didn't need to look up the IP or connect, so these are only there for new ones
+    if "dns" in timing:
+        STAGE_SECONDS.observe(timing["dns"], stage="dns")
+    if "connect" in timing:
+        STAGE_SECONDS.observe(timing["connect"], stage="connect")
+    WEBSITE_RETRIES.inc(timing["attempts"] - 1)
+    # only a 200 says anything about the username. A 429, a 403 or a server error just means t.me doesn't talk to us
+    # right now, and mustn't be mistaken for a username which doesn't exist
+    if response.status != 200:
+        response.release()
+        raise WebsiteUnavailableError
+    try:
+        if STREAMING_PARSER:
+            # this reads the page while it comes in and stops once it has everything we need. It releases the
+            # response itself, because it might read the rest of the page in the background
+            with STAGE_SECONDS.timer(stage="parse"):
+                names, bio, extra = await parse_response(response, session.body_limit)
         else:
-            chat_type = "channel"
-        # and we return the three important information as a tuple
-        return names, bio, chat_type
+            async with response:
+                # the whole website is put in one string here for further processing. This has a stage of its own,
+                # so every fetch is counted once
+                with STAGE_SECONDS.timer(stage="read"):
+                    page = await read_text(response, session.body_limit)
+            with STAGE_SECONDS.timer(stage="parse"):
+                names, bio, extra = parse_page(page)
+    except (AttributeError, IndexError):
+        # a page without a body or an og:title isn't one of the pages t.me has for usernames. It says nothing about
+        # the username, same as an error status
+        raise WebsiteUnavailableError
+    record_fetch(time.monotonic() - start)
+    # if the regex fails, the username doesn't exists, or at least I hope so. This is also closely monitored for now
+    if extra is None:
+        # this is a bit of a hacky way to tell the code later that the username is invalid
+        raise RegexFailedError
+    # now we can determine the type depending on the extra. its going to be the username for private chats,
+    # the subscriber count for channels, the members count (+ online members) for supergroups.
+    if extra.startswith("@"):
+        chat_type = "private"
+    elif "online" in extra or "members" in extra:
+        # channels have subscribers instead
+        chat_type = "supergroup"
+    else:
+        chat_type = "channel"
+    # and we return the three important information as a tuple
+    return names, bio, chat_type
 
 
 # type hint for the response, same way telegram returns it. Non existing keys are dropped, that's why total is false
@@ -146,13 +384,99 @@ def create_response(username: str, info_dict: "Username") -> ResponseDict:
             data["result"]["bio"] = info_dict["bio"]
     else:
         # the bot api has the prepending -100 for supergroups/channels, so we add it here
-        data["result"]["id"] = int("-100" + str(data["result"]["id"]))
+        data["result"]["id"] = bot_api_id(info_dict)
         data["result"]["title"] = info_dict["first_name"]
         if info_dict["bio"]:
             data["result"]["description"] = info_dict["bio"]
     return data
 
 
+# this stands in for the username while a response is encoded, so the username can be put in afterwards. It can't be
+# part of a chat, ujson escapes it
+USERNAME_MARK = "\x00"
+USERNAME_FIELD = b'"username":"\\u0000"'
+
+
+def encode_response(username: str, entry: "CacheEntry") -> bytes:
+    """
+    This returns the json body of the response for the entry. The entry keeps it around, so only the first request
+    after the entry changed encodes it. The username is put into it for every request, it is a valid username by now,
+    so it doesn't need any escaping.
+    """
+    if entry.encoded is None:
+        body = json.dumps(create_response(USERNAME_MARK, entry)).encode()  # type: ignore[arg-type]
+        # the username comes before the name and the bio, so the first one is the mark
+        before, _, after = body.partition(USERNAME_FIELD)
+        entry.encoded = (before + b'"username":"', b'"' + after)
+    return entry.encoded[0] + username.encode() + entry.encoded[1]
+
+
+async def rate_limited(api_key: str, budget: str) -> "Optional[LookupResult]":
+    # this takes a token out of the budget of the key, and returns the error telegram would give if there was none
+    retry_after = take(api_key, budget)
+    if not retry_after:
+        return None
+    # this function call increases a counter for how many requests each api key did
+    await increase_counter(api_key, "rate_limited")
+    return 429, create_error_response(
+        429, f"Too Many Requests: retry after {retry_after}", retry_after
+    )
+
+
+def encode_result(user_name: str, status: int, result: "Any") -> "Tuple[int, bytes]":
+    # this turns what resolve returned into the status code and the body of the response
+    if status == 200:
+        return 200, encode_response(user_name, result)
+    if status == STALE_STATUS:
+        # the stale mark goes right behind the result
+        return 200, encode_response(user_name, result)[:-1] + b',"stale":true}'
+    return status, json.dumps(result).encode()
+
+
+def request_deadline(request: web.Request) -> "Optional[float]":
+    # this is the monotonic time the request has to be answered by, or None if the timeout parameter is broken
+    try:
+        timeout = float(request.rel_url.query.get("timeout", DEADLINE))
+    except ValueError:
+        return None
+    if not timeout > 0:
+        return None
+    return time.monotonic() + min(timeout, DEADLINE)
+
+
+def timeout_error() -> web.Response:
+    return web.json_response(
+        data=create_error_response(
+            400, "Bad Request: timeout has to be a positive number of seconds"
+        ),
+        status=400,
+        dumps=json.dumps,
+    )
+
+
+def cacheable_response(
+    request: web.Request, body: bytes, entry: "Username", stale: bool
+) -> web.Response:
+    """
+    This sends the chat with an ETag and tells caches in front of us how long they can keep it, which is as long as we
+    would serve it from the cache without asking again. If the caller has the same response already, it only gets a
+    304.
+    """
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    # an entry which is stale is verified in the background, so the next request might get a newer one
+    age = time.time() - entry.get("verified", 0)
+    max_age = 0 if stale else max(int(FRESH_FOR - age), 0)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": f"max-age={max_age}"}
+    if any(tag.value in (etag, "*") for tag in request.if_none_match or ()):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
+
+def json_body_response(body: bytes, status: int = 200) -> web.Response:
+    # this sends a body which is json already
+    return web.Response(body=body, status=status, content_type="application/json")
+
+
 def create_error_response(code, description, retry_after=None):
     data = {
         "ok": False,
@@ -168,68 +492,464 @@ def create_error_response(code, description, retry_after=None):
 @exception_decorator
 async def endpoint(
     request: web.Request,
-    clients: "list[TelegramClient]",
+    clients: "ClientPool",
     cache: "MutableMapping[str, Username]",
-    session: "ClientSession",
+    session: "ScrapeClient",
 ) -> web.Response:
-    # this is just here so mypy is happy. It could stay as the first client, but could change later, that happens in the
-    # for loop
-    # this client variable will be set to the client if they aren't all hit with a flood error
-    client: "TelegramClient" = clients[0]
-    # from the available clients, we select one
-    for potential_client in clients:
-        # noinspection PyUnresolvedReferences
-        # the above line is so PyCharm doesn't complain over a valid access. We use the filename as a unique
-        # name for the client, which should make it easy to add more clients in the future
-        client_name = potential_client.session.filename
-        # this checks if the client is not in flood wait, then we select it
-        if client_name not in flood_wait:
-            client = potential_client
-            break
-        elif potential_client == clients[-1]:
-            # this logic is True if all clients are hit by a floodwait error. Currently, this timer
-            # is updated every second, so we are not missing time. Depending on the limits we hit and the strain this
-            # countdown (especially with several clients) puts on our system we might need to change this. The logic
-            # behind this is good though: The client_name is set to False if no flood, or a number if its flood
-            # the response mimics telegrams error responses. We pass the lowest floodwait as error.
-            return web.json_response(
-                data=create_error_response(
-                    429, "Telegram forces us to wait", flood_wait[min(flood_wait)]
-                ),
-                status=429,
-            )
     # this gets the username from the url query
     user_name = request.rel_url.query["username"]
     # if the submitted username starts with an @, it is removed here. not having it later is exactly how telegram
     # returns usernames, so this is fine
     if user_name.startswith("@"):
         user_name = user_name[1:]
+    deadline = request_deadline(request)
+    if deadline is None:
+        return timeout_error()
+    status, result = await resolve(
+        user_name, request.rel_url.query["api_key"], clients, cache, session, deadline
+    )
+    stale = status == STALE_STATUS
+    # here we get the encoded response of the chat, or the error, and send it. The username is the one from this
+    # request, so every caller gets the capitalization they asked for
+    with STAGE_SECONDS.timer(stage="encode"):
+        status, body = encode_result(user_name, status, result)
+    RESULTS.inc(status=str(status))
+    if status != 200:
+        return json_body_response(body, status)
+    return cacheable_response(request, body, result, stale)  # type: ignore[arg-type]
+
+
+# the exception decorator will try to send a message to telegram telling me about an error here
+@exception_decorator
+async def chat_id_endpoint(
+    request: web.Request,
+    clients: "ClientPool",
+    cache: "UsernameCache",
+    session: "ScrapeClient",
+) -> web.Response:
+    # this is the other way round: the chat id comes in, the chat with its current username goes out
+    try:
+        chat_id = int(request.rel_url.query["chat_id"])
+    except ValueError:
+        return web.json_response(
+            data=create_error_response(400, "Bad Request: chat_id has to be a number"),
+            status=400,
+            dumps=json.dumps,
+        )
+    deadline = request_deadline(request)
+    if deadline is None:
+        return timeout_error()
+    user_name = cache.by_chat_id(chat_id)
+    status, result = 400, create_error_response(400, "Bad Request: chat not found")
+    if user_name:
+        # the username goes through the usual lookup, so an old entry is verified like any other. If the username
+        # belongs to someone else by now, we don't know where the chat went
+        status, result = await resolve(
+            user_name,
+            request.rel_url.query["api_key"],
+            clients,
+            cache,
+            session,
+            deadline,
+        )
+        # the lookup updates the index, so if the username isn't one of the chat anymore, it doesn't point there
+        if status == 200 and user_name not in cache.usernames(chat_id):
+            status, result = 400, create_error_response(
+                400, "Bad Request: chat not found"
+            )
+    with STAGE_SECONDS.timer(stage="encode"):
+        status, body = encode_result(user_name or "", status, result)
+    RESULTS.inc(status=str(status))
+    return json_body_response(body, status)
+
+
+# the exception decorator will try to send a message to telegram telling me about an error here
+@exception_decorator
+async def batch_endpoint(
+    request: web.Request,
+    clients: "ClientPool",
+    cache: "MutableMapping[str, Username]",
+    session: "ScrapeClient",
+) -> web.StreamResponse:
+    # the usernames are passed as a json list in the body
+    try:
+        user_names = await request.json(loads=json.loads)
+    except ValueError:
+        user_names = None
+    if type(user_names) != list or not all(type(name) == str for name in user_names):
+        return web.json_response(
+            data=create_error_response(
+                400, "Bad Request: the body has to be a json list of usernames"
+            ),
+            status=400,
+            dumps=json.dumps,
+        )
+    if len(user_names) > BATCH_LIMIT:
+        return web.json_response(
+            data=create_error_response(
+                400, f"Bad Request: too many usernames, the limit is {BATCH_LIMIT}"
+            ),
+            status=400,
+            dumps=json.dumps,
+        )
+    # the whole batch has to be done by the deadline, the usernames which aren't get the timeout error
+    deadline = request_deadline(request)
+    if deadline is None:
+        return timeout_error()
+    api_key = request.rel_url.query["api_key"]
+    # this limits how many usernames of this request are resolved at the same time
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def resolve_one(index: int, user_name: str) -> "Tuple[int, bytes]":
+        # same as in the endpoint, the leading @ is removed
+        if user_name.startswith("@"):
+            user_name = user_name[1:]
+        try:
+            async with semaphore:
+                status, result = await resolve(
+                    user_name, api_key, clients, cache, session, deadline
+                )
+        except Exception as e:
+            # one username going wrong doesn't take the others with it, it gets an error of its own. We still want to
+            # hear about it, like the exception decorator would tell us
+            report_exception(e)
+            status, result = 500, create_error_response(
+                500, "Internal Server Error: resolving this username failed"
+            )
+        # every username gets the same response the endpoint would give for it, already encoded
+        with STAGE_SECONDS.timer(stage="encode"):
+            status, body = encode_result(user_name, status, result)
+        RESULTS.inc(status=str(status))
+        return index, body
+
+    tasks = [
+        asyncio.ensure_future(resolve_one(index, user_name))
+        for index, user_name in enumerate(user_names)
+    ]
+    try:
+        if request.rel_url.query.get("stream", "").lower() not in ("true", "1"):
+            # the results are returned in the same order as the usernames were sent
+            results = await asyncio.gather(*tasks)
+            # the responses are encoded already, they only have to be put together
+            body = (
+                b'{"ok":true,"result":['
+                + b",".join(response for _, response in results)
+                + b"]}"
+            )
+            batch = json_body_response(body)
+            # a big batch is sent compressed if the caller takes it. The streaming mode isn't, the compression would
+            # hold the lines back until it has enough of them
+            if len(body) >= COMPRESS_AFTER:
+                batch.enable_compression()
+            return batch
+        # in the streaming mode, every result is written as its own json line as soon as it is ready. The index tells
+        # the caller which username it belongs to
+        response = web.StreamResponse()
+        response.content_type = "application/x-ndjson"
+        await response.prepare(request)
+        for task in asyncio.as_completed(tasks):
+            index, result = await task
+            await response.write(b'{"index":%d,"response":%s}\n' % (index, result))
+        await response.write_eof()
+        return response
+    finally:
+        # if something went wrong, we don't need the rest anymore
+        for task in tasks:
+            task.cancel()
+
+
+async def resolve(
+    user_name: str,
+    api_key: str,
+    clients: "ClientPool",
+    cache: "MutableMapping[str, Username]",
+    session: "ScrapeClient",
+    deadline: float,
+) -> "LookupResult":
+    """
+    This answers from the cache if the entry was verified recently. Otherwise, it makes sure only one lookup per
+    username runs at a time. If there is one running already, we wait for its result instead of scraping the website
+    and calling the API a second time. We wait until the monotonic deadline at most.
+    """
+    key = user_name.lower()
+    # usernames which can't exist, or didn't exist a few minutes ago, are answered right away. This is the same error
+    # telegram gives, and it doesn't cost us anything
+    if not valid_username(user_name) or is_not_found(key):
+        # this is answered without asking anyone, so it takes from the cache budget
+        limited = await rate_limited(api_key, "cache")
+        if limited:
+            return limited
+        # this function call increases a counter for how many requests each api key did
+        await increase_counter(api_key, "not_found")
+        CACHE_RESULTS.inc(outcome="not_found")
+        return 400, create_error_response(400, "Bad Request: chat not found")
+    # this tells the refresher which usernames are popular
+    popularity.hit(key)
+    with STAGE_SECONDS.timer(stage="cache"):
+        known = cache.get(key)
+    if known:
+        # entries from before we stored the timestamp count as very old
+        age = time.time() - known.get("verified", 0)
+        if age < STALE_FOR:
+            limited = await rate_limited(api_key, "cache")
+            if limited:
+                return limited
+            CACHE_RESULTS.inc(outcome="stale" if age >= FRESH_FOR else "hit")
+            if age >= FRESH_FOR:
+                # the entry is served as it is, and verified in the background for the next request
+                start_lookup(
+                    user_name,
+                    None,
+                    clients,
+                    cache,
+                    session,
+                    background_lookup,
+                )
+            # this function call increases a counter for how many requests each api key did
+            await increase_counter(api_key, "cache")
+            return 200, known
+    # waiting for a lookup which runs anyway doesn't cost anything, a new one does
+    limited = await rate_limited(api_key, "cache" if key in in_flight else "upstream")
+    if limited:
+        return limited
+    CACHE_RESULTS.inc(outcome="miss")
+    new = key not in in_flight
+    if new:
+        # a new lookup has to wait for a slot, the other keys get their turns as well
+        refused = await admit(api_key, clients, known, deadline)
+        if refused:
+            return refused
+        # someone else might have started the lookup while we waited
+        if key in in_flight:
+            admission.release()
+            new = False
+    if not new:
+        # this function call increases a counter for how many requests each api key did
+        await increase_counter(api_key, "coalesced")
+        COALESCED.inc()
+    future = start_lookup(user_name, api_key, clients, cache, session, lookup)
+    if new:
+        # the slot is given back once the lookup is done, no matter who waits for it by then
+        started = time.monotonic()
+        future.add_done_callback(
+            lambda _: admission.release(time.monotonic() - started)
+        )
+    # the shield keeps a cancelled request from cancelling the lookup for the others, this includes a request which
+    # ran out of time
+    try:
+        if deadline + DEADLINE_SLACK >= lookup_deadlines[key]:
+            status, result = await asyncio.shield(future)
+        else:
+            status, result = await asyncio.wait_for(
+                asyncio.shield(future), deadline - time.monotonic()
+            )
+    except asyncio.TimeoutError:
+        # we ran out of time, the lookup goes on for the others
+        return await timed_out(api_key, known)
+    except asyncio.CancelledError:
+        # the lookup ran out of time. If it is this request which is cancelled, that goes on
+        if not future.cancelled():
+            raise
+        return await timed_out(api_key, known)
+    except WEBSITE_ERRORS:
+        if not (SERVE_STALE and known):
+            raise
+        return await serve_stale(api_key, known)
+    # a flood wait doesn't matter if we have the chat already
+    if status == 429 and SERVE_STALE and known:
+        return await serve_stale(api_key, known)
+    return status, result
+
+
+async def admit(
+    api_key: str,
+    clients: "ClientPool",
+    known: "Optional[Username]",
+    deadline: float,
+) -> "Optional[LookupResult]":
+    """
+    This waits until a new lookup may start, and returns None then. If the line is too long, or the deadline passes
+    while waiting, it returns what the request gets instead.
+    """
+    # the clients in a flood wait can't take any lookups
+    ticket = admission.admit(api_key, LOOKUPS_PER_CLIENT * max(clients.usable(), 1))
+    if ticket is None:
+        return None
+    if isinstance(ticket, int):
+        ADMISSION_REJECTED.inc()
+        if SERVE_STALE and known:
+            return await serve_stale(api_key, known)
+        # this function call increases a counter for how many requests each api key did
+        await increase_counter(api_key, "rate_limited")
+        return 429, create_error_response(
+            429, f"Too Many Requests: retry after {ticket}", ticket
+        )
+    try:
+        with STAGE_SECONDS.timer(stage="queue"):
+            await asyncio.wait_for(ticket, deadline - time.monotonic())
+    except asyncio.TimeoutError:
+        admission.leave(ticket)
+        return await timed_out(api_key, known)
+    except asyncio.CancelledError:
+        admission.leave(ticket)
+        raise
+    return None
+
+
+async def serve_stale(api_key: str, known: "Username") -> "LookupResult":
+    # the entry couldn't be verified, it is served anyway, with the mark that it might be outdated
+    DEGRADED.inc()
+    # this function call increases a counter for how many requests each api key did
+    await increase_counter(api_key, "cache")
+    return STALE_STATUS, known
+
+
+async def timed_out(api_key: str, known: "Optional[Username]") -> "LookupResult":
+    # telegram didn't answer before the deadline, if we know the chat, that is served anyway
+    if SERVE_STALE and known:
+        return await serve_stale(api_key, known)
+    TIMEOUTS.inc()
+    return 504, create_error_response(
+        504, "Gateway Timeout: telegram didn't answer in time"
+    )
+
+
+def start_lookup(
+    user_name: str,
+    api_key: "Optional[str]",
+    clients: "ClientPool",
+    cache: "MutableMapping[str, Username]",
+    session: "ScrapeClient",
+    lookup_function: "Callable[..., Coroutine[Any, Any, LookupResult]]",
+) -> "asyncio.Future[LookupResult]":
+    # this returns the running lookup for the username, or starts one if there is none
+    key = user_name.lower()
+    if key not in in_flight:
+        # the lookup runs as its own task, so it finishes for everyone waiting even if the first request goes away
+        deadline = time.monotonic() + DEADLINE
+        task = asyncio.ensure_future(
+            lookup_function(user_name, api_key, clients, cache, session, deadline)
+        )
+        # at the deadline, the lookup is cancelled wherever it is. One timer is cheaper than a timeout around every call
+        timer = asyncio.get_event_loop().call_later(DEADLINE, task.cancel)
+        in_flight[key] = task
+        lookup_deadlines[key] = deadline
+
+        def finished(_: "asyncio.Future[LookupResult]") -> None:
+            timer.cancel()
+            in_flight.pop(key, None)
+            lookup_deadlines.pop(key, None)
+
+        task.add_done_callback(finished)
+        # a background lookup might not have anyone waiting for it. The exception decorator already told us about an
+        # error, so we mark it as retrieved to keep asyncio from complaining
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+    return in_flight[key]
+
+
+async def refresh_popular(
+    clients: "ClientPool",
+    cache: "MutableMapping[str, Username]",
+    session: "ScrapeClient",
+) -> None:
+    """
+    This runs in the background forever. It verifies the entries of the most popular usernames before they stop being
+    fresh, the same way a request would, so the requests for them are answered from the cache. As soon as a client gets
+    a flood wait, it stops until the next round, the requests need the clients more.
+    """
+    decayed = time.monotonic()
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        if time.monotonic() - decayed >= DECAY_INTERVAL:
+            popularity.decay()
+            decayed = time.monotonic()
+        for key in popularity.hottest(REFRESH_COUNT):
+            if clients.waits():
+                break
+            known = cache.get(key)
+            # usernames which don't exist have nothing to refresh, and recently verified ones don't need it
+            if not known or time.time() - known.get("verified", 0) < REFRESH_AFTER:
+                continue
+            # if a request for the username comes in meanwhile, it waits for this lookup. If it fails, we heard about
+            # it already, and the next entry might work
+            await asyncio.wait(
+                (start_lookup(key, None, clients, cache, session, background_lookup),)
+            )
+            REFRESHES.inc()
+            await asyncio.sleep(REFRESH_PAUSE)
+
+
+async def background_lookup(
+    user_name: str,
+    api_key: "Optional[str]",
+    clients: "ClientPool",
+    cache: "MutableMapping[str, Username]",
+    session: "ScrapeClient",
+    deadline: float,
+) -> "LookupResult":
+    """
+    This is the lookup for stale entries and the refresher. The website failing or the deadline passing is expected
+    every now and then, that is only counted. Anything else is sent to the log channel, like the exception decorator
+    does for the requests. Either way the error is raised again for the requests which wait for the lookup.
+    """
+    try:
+        return await lookup(user_name, api_key, clients, cache, session, deadline)
+    except WEBSITE_ERRORS as e:
+        # the timeout of the deadline is one of these as well
+        BACKGROUND_FAILURES.inc(error=type(e).__name__)
+        raise
+    except Exception as e:
+        report_exception(e)
+        raise
+
+
+async def lookup(
+    user_name: str,
+    api_key: "Optional[str]",
+    clients: "ClientPool",
+    cache: "MutableMapping[str, Username]",
+    session: "ScrapeClient",
+    deadline: float,
+) -> "LookupResult":
+    # the website and the API together have until the monotonic deadline, start_lookup cancels whatever runs after that
     # this is set to the cached data, if it exists, so we can use it to compare it to the website
     known: Union[Literal[False], "Username"] = False
     if user_name.lower() in cache:
         # setting it to lower avoids issues with the case
         known = cache[user_name.lower()]
+    # if all clients are hit by a floodwait error and we don't know the chat, we can't do anything. The response mimics
+    # telegrams error responses, we pass the time until the first client is available again as retry_after. If we know
+    # it, the website might still confirm it without the API
+    if not known and not clients.has_available():
+        return 429, create_error_response(
+            429, "Telegram forces us to wait", clients.retry_after()
+        )
+    # the type of the chat decides which API call we make. None means we don't know it, and resolve the username first
+    chat_type: "Optional[str]" = None
     # this check does not try to parse websites for usernames which exist but generate a wrong website.
-    if user_name.lower() not in COPYRIGHT_USERNAMES:
+    if user_name.lower() in COPYRIGHT_USERNAMES:
+        # we set chat type from the hardcoded dict, because we need it to call the correct api method
+        chat_type = COPYRIGHT_USERNAMES[user_name.lower()]
+    # a username we don't know needs the API anyway. The website would only tell us the chat type, and resolving the
+    # username tells us that as well
+    elif known or not RESOLVE_MISSES:
         # this subscribes the tuple result to three unique variables
         try:
-            names, bio, chat_type = await website(user_name, session=session)
+            names, bio, chat_type = await website(user_name, session, deadline)
         except RegexFailedError:
             # if that error is raised, this means the username is invalid (or so I hope), so we raise a BadRequest
             # error.
             # we also log this (and the traceback) to a channel so we can do close monitoring for now
             # traceback.format_tb returns the usual python message about an exception, but as a
-            # list of strings rather than a single string, so we have to join them together. We use the first client
-            # to log
-            # because that is the one which we require to be in the log chat
+            # list of strings rather than a single string, so we have to join them together
             tb_list = traceback.format_tb(sys.exc_info()[2])
             tb_string = "".join(tb_list)
-            await log_call(clients[0], user_name, rg_traceback=tb_string)
+            log_call(user_name, rg_traceback=tb_string)
+            # the chat is gone, so cached data is of no use anymore. And we remember that, so we don't look again
+            cache.pop(user_name.lower(), None)
+            remember_not_found(user_name.lower())
             # this gives the error to the user the same way telegram does
-            return web.json_response(
-                data=create_error_response(400, "Bad Request: chat not found"),
-                status=400,
-            )
+            return 400, create_error_response(400, "Bad Request: chat not found")
         # known is set to the cached data, so if we have data here, we can use it
         if known:
             known_names = known["first_name"]
@@ -245,148 +965,258 @@ async def endpoint(
                 and bio == known["bio"]
                 and chat_type == known["chat_type"]
             ):
-                # this function call increases a counter for how many requests each api key did
-                await increase_counter(request.rel_url.query["api_key"], "cache")
-                # here we pass the cached data to the dict creation and then return the json response as response
-                data = create_response(user_name, known)
-                return web.json_response(data=data)
-    else:
-        # we set chat type from the hardcoded dict, because we need it to call the correct api method
-        chat_type = COPYRIGHT_USERNAMES[user_name.lower()]
+                # the website confirmed the entry, so it counts as fresh again. It is set again so the cache notices
+                known["verified"] = time.time()
+                cache[user_name.lower()] = known
+                # this function call increases a counter for how many requests each api key did. Lookups running in
+                # the background don't have an api key, they aren't requests
+                if api_key:
+                    await increase_counter(api_key, "cache")
+                # here we pass the cached data back, the response is created by the endpoint
+                return 200, known
     # if we reached this part of the code, we either don't have cached values, or they are out of date, or we couldn't
     # use the website to verify them. So we get new
-    # ones from telegram at this point. This is its own function because we need it to be recursive to switch clients
-    potential_error = await get_chat_from_api(
-        client, chat_type, user_name, clients, cache
-    )
-    # a floodwait response could be returned so we check for it here
-    if type(potential_error) == web_response.Response:
+    # ones from telegram at this point. The pool gives us the client which wasn't used for the longest time. It can be
+    # None if the last clients got a flood wait while we were looking at the website
+    client = clients.acquire()
+    if client is None:
+        return 429, create_error_response(
+            429, "Telegram forces us to wait", clients.retry_after()
+        )
+    # These are their own functions because we need them to be recursive to switch clients
+    if chat_type is None:
+        potential_error = await resolve_from_api(
+            client, user_name, clients, cache, deadline
+        )
+    else:
+        potential_error = await get_chat_from_api(
+            client, chat_type, user_name, clients, cache, deadline
+        )
+    # a floodwait or bad request error could be returned so we check for it here
+    if potential_error:
         # this needs to be returned to the server so we return
         return potential_error
     # this function call increases a counter for how many requests each api key did
-    await increase_counter(request.rel_url.query["api_key"], "api_call")
-    # here it is send to the dict creation function, and the result is given as a web response. Getting it from cache
-    # might be a bit resource wasting, but this is python, so who cares
-    data = create_response(user_name, cache[user_name.lower()])
-    return web.json_response(data=data)
-
-
-async def flood_runs_out(client: str) -> None:
-    # this is the countdown to update the flood wait time. It is set to one second right now, this can be
-    # changed/made smarter later.
-    while flood_wait[client] >= 0:
-        await asyncio.sleep(10)
-        # subtracting one second from the time we have to wait because we slept one second
-        flood_wait[client] -= 10
-    # if wait is 0 or less, we set it to false, and then break the loop.
-    del flood_wait[client]
+    if api_key:
+        await increase_counter(api_key, "api_call")
+    # here the fresh data is given back. Getting it from cache might be a bit resource wasting, but this is python, so
+    # who cares
+    return 200, cache[user_name.lower()]
 
 
 async def get_chat_from_api(
     client: "TelegramClient",
     chat_type: str,
     user_name: str,
-    clients: "list[TelegramClient]",
+    clients: "ClientPool",
     cache: "MutableMapping[str, Username]",
-):
-    # this whole function is recursive. It will call itself if one client reaches a FloodWaitError
+    deadline: float,
+) -> "Optional[LookupResult]":
+    # this whole function is recursive. It will call itself if one client reaches a FloodWaitError. Once the monotonic
+    # deadline passed, there is no point in asking another client
+    if time.monotonic() >= deadline:
+        raise asyncio.TimeoutError
+    # if this client got the chat from telegram before, it can ask about it directly. Otherwise telethon has to resolve
+    # the username first, unless it has it in the session
+    peer = stored_peer(cache.get(user_name.lower()), client, chat_type)
     try:
-        if chat_type == "private":
-            # noinspection PyTypeChecker
-            # the above line is so PyCharm doesn't complain about user_name being the username, telethon is totally fine
-            # with this. We have to get the full user/chat in order to get the bio of the chat
-            full = await client(GetFullUserRequest(user_name))
-        else:
-            # noinspection PyTypeChecker
-            # same as above, just a slightly different api call
-            full = await client(GetFullChannelRequest(user_name))
+        with STAGE_SECONDS.timer(stage="api"):
+            if chat_type == "private":
+                # noinspection PyTypeChecker
+                # the above line is so PyCharm doesn't complain about user_name being the username, telethon is totally
+                # fine with this. We have to get the full user/chat in order to get the bio of the chat
+                full = await client(GetFullUserRequest(peer or user_name))
+            else:
+                # noinspection PyTypeChecker
+                # same as above, just a slightly different api call
+                full = await client(GetFullChannelRequest(peer or user_name))
     except errors.FloodWaitError as e:
         # now we can check if there are other clients left we can try
         # since we have to do the exact same logic for the non private chat, I moved it to it's own function, see
         # below
-        await flood_error(client, user_name, e, clients)
+        flood_error(client, user_name, e, clients)
         # now we can check if there are more clients available to instead do the function call
-        # how this for loop works, see above
-        for potential_client in clients:
-            # noinspection PyUnresolvedReferences
-            client_name = potential_client.session.filename
-            # this checks if the client is not in flood wait, then we select it
-            if client_name not in flood_wait:
-                return await get_chat_from_api(
-                    potential_client, chat_type, user_name, clients, cache
-                )
+        potential_client = clients.acquire()
+        if potential_client:
+            return await get_chat_from_api(
+                potential_client, chat_type, user_name, clients, cache, deadline
+            )
         # If we reached this part of the code, it means all clients are sadly hit with a FloodWait. We return the lowest
         # and go on with our life
         # this also resolves in a specific log call
-        await log_call(clients[0], user_name, all_clients_hit=str(flood_wait))
-        return web.json_response(
-            create_error_response(429, "Telegram forces us to wait", e.seconds),
-            status=429,
+        log_call(user_name, all_clients_hit=str(clients.waits()))
+        return 429, create_error_response(
+            429, "Telegram forces us to wait", clients.retry_after()
         )
     except ValueError as e:
         # the ValueError happens when the API returns that the username is unknown. This could happen with the hardcoded
         # values, or just with a very badly timed username change
-        await log_call(clients[0], user_name, username_not_found=e.args[0])
+        log_call(user_name, username_not_found=e.args[0])
+        # if we had this chat cached, the data is of no use anymore. And we remember that, so we don't ask again
+        cache.pop(user_name.lower(), None)
+        remember_not_found(user_name.lower())
         # we return the bad request to the user
-        return web.json_response(
-            data=create_error_response(400, "Bad Request: chat not found"),
-            status=400,
-        )
-    except TypeError as e:
+        return 400, create_error_response(400, "Bad Request: chat not found")
+    except TypeError:
         # for some reasons, some channels show up as private chats from the website. if that happens, telegram throws
-        # a typeerror, so we expect it, change the type and call the function again. I would really like to do something
-        # about this, but I can't reproduce it
-        if chat_type == "private":
-            # it could also be a supergroup, I have no idea, I would rather say its something it isn't but still serve
-            # the id
-            return await get_chat_from_api(
-                client, "channel", user_name, clients, cache
-            )
-        else:
-            # this is luckily clear
-            return await get_chat_from_api(
-                client, "private", user_name, clients, cache
+        # a typeerror. Instead of guessing the other type, we ask telegram what the username is
+        return await resolve_from_api(client, user_name, clients, cache, deadline)
+    except STALE_PEER_ERRORS:
+        # the stored access hash doesn't work anymore, so we ask telegram what the username is now
+        return await resolve_from_api(client, user_name, clients, cache, deadline)
+    # the stored chat might not have the username anymore, then someone else might have it
+    if peer and not has_username(
+        full.users[0] if chat_type == "private" else full.chats[0], user_name
+    ):
+        return await resolve_from_api(client, user_name, clients, cache, deadline)
+    write_chat(cache, user_name, chat_type, full, client)
+    return None
+
+
+async def resolve_from_api(
+    client: "TelegramClient",
+    user_name: str,
+    clients: "ClientPool",
+    cache: "MutableMapping[str, Username]",
+    deadline: float,
+) -> "Optional[LookupResult]":
+    """
+    This resolves the username, which tells us if it is a user, a supergroup or a channel, and gets the full chat with
+    the matching call right away. Like get_chat_from_api, it calls itself with the next client on a flood wait.
+    """
+    if time.monotonic() >= deadline:
+        raise asyncio.TimeoutError
+    try:
+        with STAGE_SECONDS.timer(stage="api"):
+            resolved = await client(ResolveUsernameRequest(user_name))
+            # the access hash belongs to this client, so a flood wait in between means resolving again with the next
+            if isinstance(resolved.peer, PeerUser):
+                chat_type = "private"
+                user = next(
+                    user for user in resolved.users if user.id == resolved.peer.user_id
+                )
+                full = await client(
+                    GetFullUserRequest(InputUser(user.id, user.access_hash))
+                )
+            else:
+                channel = next(
+                    chat
+                    for chat in resolved.chats
+                    if chat.id == resolved.peer.channel_id
+                )
+                # the API call is the same for both, but the bot API tells them apart
+                chat_type = "supergroup" if channel.megagroup else "channel"
+                full = await client(
+                    GetFullChannelRequest(InputChannel(channel.id, channel.access_hash))
+                )
+    except errors.FloodWaitError as e:
+        # this is the same as in get_chat_from_api
+        flood_error(client, user_name, e, clients)
+        potential_client = clients.acquire()
+        if potential_client:
+            return await resolve_from_api(
+                potential_client, user_name, clients, cache, deadline
             )
+        log_call(user_name, all_clients_hit=str(clients.waits()))
+        return 429, create_error_response(
+            429, "Telegram forces us to wait", clients.retry_after()
+        )
+    except (errors.UsernameNotOccupiedError, errors.UsernameInvalidError) as e:
+        # nobody has the username, this is what the ValueError in get_chat_from_api is
+        log_call(user_name, username_not_found=str(e))
+        cache.pop(user_name.lower(), None)
+        remember_not_found(user_name.lower())
+        return 400, create_error_response(400, "Bad Request: chat not found")
+    write_chat(cache, user_name, chat_type, full, client)
+    return None
+
+
+def stored_peer(
+    known: "Optional[Username]", client: "TelegramClient", chat_type: str
+) -> "Union[InputUser, InputChannel, None]":
+    # this is the chat of the entry the way the client can ask about it, if the client has an access hash for it and
+    # the chat is still the same kind of chat
+    if not known or (known["chat_type"] == "private") != (chat_type == "private"):
+        return None
+    access_hash = (known.get("access_hashes") or {}).get(client_name(client))
+    if access_hash is None:
+        return None
+    if chat_type == "private":
+        return InputUser(known["chat_id"], access_hash)
+    return InputChannel(known["chat_id"], access_hash)
+
+
+def has_username(entity: "Any", user_name: str) -> bool:
+    # a chat can have more than one username, the others are in usernames
+    key = user_name.lower()
+    if (entity.username or "").lower() == key:
+        return True
+    return any(other.username.lower() == key for other in entity.usernames or ())
+
+
+def write_chat(
+    cache: "MutableMapping[str, Username]",
+    user_name: str,
+    chat_type: str,
+    full: "Any",
+    client: "TelegramClient",
+) -> None:
+    entity = full.users[0] if chat_type == "private" else full.chats[0]
+    key = user_name.lower()
+    # the access hashes of the other clients stay, as long as it is still the same chat
+    known = cache.get(key)
+    access_hashes = (
+        dict(known.get("access_hashes") or {})
+        if known and known["chat_id"] == entity.id
+        else {}
+    )
+    if entity.access_hash is not None:
+        access_hashes[client_name(client)] = entity.access_hash
     # and we write it to the cache. We loose capitalization of the username here, but that doesn't matter, since
     # they are case insensitive. We always return the username they put in the URL anyway
     if chat_type == "private":
-        cache[user_name.lower()] = {
-            "first_name": full.users[0].first_name,
-            "last_name": full.users[0].last_name,
+        cache[key] = {
+            "first_name": entity.first_name,
+            "last_name": entity.last_name,
             "bio": full.full_user.about,
             "chat_type": chat_type,
-            "chat_id": full.users[0].id,
+            "chat_id": entity.id,
+            "verified": time.time(),
+            "access_hashes": access_hashes or None,
         }
     # we don't have a last_name in other chats, so we set it to an empty string. Also, the return type is slightly
     # different
     else:
-        cache[user_name.lower()] = {
-            "first_name": full.chats[0].title,
+        cache[key] = {
+            "first_name": entity.title,
             "last_name": "",
             "bio": full.full_chat.about,
             "chat_type": chat_type,
-            "chat_id": full.chats[0].id,
+            "chat_id": entity.id,
+            "verified": time.time(),
+            "access_hashes": access_hashes or None,
         }
+    # the other usernames we have for the chat stay as long as telegram still lists them for it. The ones it doesn't
+    # list belong to someone else by now, or to nobody
+    if isinstance(cache, UsernameCache):
+        for other in cache.usernames(bot_api_id(cache[key])) - {key}:
+            if not has_username(entity, other):
+                cache.pop(other, None)
 
 
-async def flood_error(
+def flood_error(
     client: "TelegramClient",
     user_name: str,
     e: errors.FloodWaitError,
-    clients: "list[TelegramClient]",
+    clients: "ClientPool",
 ):
-    # noinspection PyUnresolvedReferences
-    # again, the above line is so PyCharm doesn't complain over a valid access. We use the filename as a unique
-    # name for the client, which should make it easy to add more clients in the future
-    client_name = client.session.filename
-    # we set this to True so we don't spam telegram any more then needed
-    flood_wait[client_name] = e.seconds
-    # this runs the function in the background
-    asyncio.create_task(flood_runs_out(client_name))
+    # the pool takes the client out of the rotation until the wait is over, so we don't spam telegram any more then
+    # needed
+    clients.flood(client, e.seconds)
     # and we tell our users about this. Maybe we should provide a better way to access the seconds value, I will
     # think about this later
     tb_list = traceback.format_tb(sys.exc_info()[2])
     tb_string = "".join(tb_list)
     # we add the seconds we wait for so we can make decisions based on this
     tb_string += "\n\nWaiting for " + str(e.seconds) + " seconds."
-    await log_call(clients[0], user_name, fw_traceback=tb_string)
+    log_call(user_name, fw_traceback=tb_string)
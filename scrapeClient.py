@@ -0,0 +1,169 @@
+import asyncio
+import random
+import time
+from typing import TypedDict, TYPE_CHECKING
+
+from aiohttp import (
+    ClientConnectionError,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+    TraceConfig,
+)
+
+if TYPE_CHECKING:
+    from types import SimpleNamespace
+    from typing import Awaitable, Callable, Tuple
+
+    from aiohttp import ClientResponse
+
+    TraceCallback = Callable[[ClientSession, SimpleNamespace, object], Awaitable[None]]
+
+# this module is the HTTP client we scrape t.me with. It wraps one ClientSession, so the connections are pooled, and
+# makes sure a slow or broken t.me can't hang a request forever
+
+# the whole request, body included, may take this many seconds. Opening a connection and waiting for the next piece of
+# data have their own, shorter limits
+TOTAL_TIMEOUT = 10
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 5
+# this is how many connections are open at most, and how many of them go to the same host
+CONNECTION_LIMIT = 100
+PER_HOST_LIMIT = 50
+# the IP of t.me is remembered this many seconds, and an unused connection is kept open this long
+DNS_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+# a t.me page is a few KB, everything bigger than this is not what we are looking for
+BODY_LIMIT = 512 * 1024
+# a request which failed because of the connection or one of these status codes is tried again this many times. The
+# wait in between is random, up to RETRY_BACKOFF seconds, doubled for every retry
+RETRIES = 2
+RETRY_BACKOFF = 0.1
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class ResponseTooLargeError(Exception):
+    # this is raised when the body is bigger than BODY_LIMIT
+    pass
+
+
+# this is how long the parts of a request took, in seconds. The timing of a connection which was reused has no dns and
+# connect
+class ScrapeTiming(TypedDict, total=False):
+    attempts: int
+    dns: float
+    connect: float
+    # the time until the headers of the response arrived
+    headers: float
+
+
+async def read_text(response: "ClientResponse", limit: int = BODY_LIMIT) -> str:
+    # this reads the whole body, but not more than the limit. t.me always sends a charset, utf-8 is the fallback
+    body = bytearray()
+    async for chunk in response.content.iter_any():
+        body += chunk
+        if len(body) > limit:
+            raise ResponseTooLargeError
+    return body.decode(response.charset or "utf-8", errors="replace")
+
+
+def trace_timing() -> TraceConfig:
+    # aiohttp calls these at the different points of a request, and passes the timing dict of the request along
+    trace = TraceConfig()
+
+    def start(name: str) -> "TraceCallback":
+        async def callback(
+            session: ClientSession, context: "SimpleNamespace", params: object
+        ) -> None:
+            context.started = getattr(context, "started", {})
+            context.started[name] = time.perf_counter()
+
+        return callback
+
+    def end(name: str) -> "TraceCallback":
+        async def callback(
+            session: ClientSession, context: "SimpleNamespace", params: object
+        ) -> None:
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx[name] = (
+                    time.perf_counter() - context.started[name]
+                )
+
+        return callback
+
+    trace.on_dns_resolvehost_start.append(start("dns"))
+    trace.on_dns_resolvehost_end.append(end("dns"))
+    trace.on_connection_create_start.append(start("connect"))
+    trace.on_connection_create_end.append(end("connect"))
+    trace.on_request_start.append(start("headers"))
+    trace.on_request_end.append(end("headers"))
+    return trace
+
+
+class ScrapeClient:
+    """
+    This fetches the t.me pages. It has to be created inside the event loop, like the ClientSession it wraps.
+    """
+
+    def __init__(
+        self,
+        total_timeout: float = TOTAL_TIMEOUT,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        connection_limit: int = CONNECTION_LIMIT,
+        per_host_limit: int = PER_HOST_LIMIT,
+        dns_ttl: int = DNS_TTL,
+        keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+        body_limit: int = BODY_LIMIT,
+        retries: int = RETRIES,
+        retry_backoff: float = RETRY_BACKOFF,
+    ) -> None:
+        self.body_limit = body_limit
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.session = ClientSession(
+            connector=TCPConnector(
+                limit=connection_limit,
+                limit_per_host=per_host_limit,
+                ttl_dns_cache=dns_ttl,
+                keepalive_timeout=keepalive_timeout,
+            ),
+            timeout=ClientTimeout(
+                total=total_timeout,
+                sock_connect=connect_timeout,
+                sock_read=read_timeout,
+            ),
+            trace_configs=[trace_timing()],
+        )
+
+    async def get(self, url: str) -> "Tuple[ClientResponse, ScrapeTiming]":
+        """
+        This returns the response, with the body not read yet, and how long getting it took. The caller has to release
+        the response. Connection errors, timeouts and server errors are retried.
+        """
+        timing: ScrapeTiming = {}
+        attempt = 0
+        while True:
+            timing["attempts"] = attempt + 1
+            try:
+                response = await self.session.get(url, trace_request_ctx=timing)
+            except (ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    # if the server tells us the body is too big, we don't even start reading it
+                    if (
+                        response.content_length is not None
+                        and response.content_length > self.body_limit
+                    ):
+                        response.close()
+                        raise ResponseTooLargeError
+                    return response, timing
+                response.release()
+            # full jitter, so retries of many requests which failed at once don't hit t.me at once again
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * 2**attempt))
+            attempt += 1
+
+    async def close(self) -> None:
+        await self.session.close()
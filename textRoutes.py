@@ -1,4 +1,9 @@
 from aiohttp import web
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from clientPool import ClientPool
+    from cacheStore import UsernameCache
 
 # these functions just return strings. It might make sense to move them to their own folder later and turn them to plain
 # html files.
@@ -30,16 +35,53 @@ async def index(request: web.Request):
 
 async def api_documentation(_: web.Request):
     string = (
-        "This document represents the whole documentation of the usernameToChatAPI.\n\nThere is currently one "
-        "supported GET request: resolveUsername. This method takes two parameters, api_key and username. Submit them "
-        "via an URL query string. If you want a different way of submitting these parameters, open an issue about it, "
-        "and we will find a way. The api_key is case sensitive, the username can be passed with or without a leading @."
-        "\n\nThe successful call will result in a json response, mimicking the getChat response from "
-        "the telegram API for the respective types: https://core.telegram.org/bots/api#chat. Bio/description are "
-        "passed if present as well. Photo is not passed, this wouldn't make sense.\n\nError handling is the same as "
-        "telegram does it. Expected errors are 400, when the chat is not found or parameters are missing, 401, when "
-        "the API key is wrong, and 429, if the API is hit with a "
-        "flood wait error. The retry_after attribute is present in this case so you can wait that long before making "
-        "more requests."
+        "This document represents the whole documentation of the usernameToChatAPI.\n\nThere are two GET requests, "
+        "resolveUsername and resolveChatId, and one POST request, resolveUsernames. resolveUsername takes two "
+        "parameters, api_key and username. Submit them via an URL query string. If you want a different way of "
+        "submitting these parameters, open an issue about it, and we will find a way. The api_key is case sensitive, "
+        "the username can be passed with or without a leading @.\n\nThe successful call will result in a json "
+        "response, mimicking the getChat response from the telegram API for the respective types: "
+        "https://core.telegram.org/bots/api#chat. Bio/description are passed if present as well. Photo is not passed, "
+        "this wouldn't make sense.\n\nError handling is the same as telegram does it. Expected errors are 400, when "
+        "the chat is not found or parameters are missing, 401, when the API key is wrong, and 429, if the API is hit "
+        "with a flood wait error. The retry_after attribute is present in this case so you can wait that long before "
+        "making more requests. If we know the chat already but can't ask telegram about it right now, you get what we "
+        "know instead, and the response has stale set to true next to ok and result. Every api key has a rate limit as "
+        "well, for usernames which are answered from the cache and for the ones we have to ask telegram about. Going "
+        "over it gives the same 429 with retry_after, every username of a batch counts. If a lot of usernames need "
+        "telegram at once, the keys take turns, and when the wait would be too long you get that 429 as well. A "
+        "username which doesn't exist is remembered as such for ten minutes, so if you just took it, give it a "
+        "moment.\n\nEvery request is answered within ten seconds. You can ask for less by adding timeout with the "
+        "seconds to the query string. If telegram doesn't answer in time, you get a 504, or the stale chat if we know "
+        "it. For resolveUsernames, the timeout is for the whole batch.\n\nIf you need a lot of usernames at once, send "
+        "a POST request to resolveUsernames. The api_key goes into the URL query string, the usernames are the body, "
+        "as a json list of up to 500 strings. The response is a json object with ok set to true and the result being a "
+        "list, which holds the response resolveUsername would give for each username (including errors) in the same "
+        "order. If you add stream=true to the query string, you get the results as newline delimited json instead, one "
+        "line per username as soon as it is resolved. Each line has the index of the username in your list and the "
+        "response for it.\n\nIf you have a chat id and want to know the username, send a GET request to resolveChatId "
+        "with api_key and chat_id. The id of supergroups and channels can be passed with or without the -100. This "
+        "only knows chats which were resolved with this API before, and the username in the response is lowercase. If "
+        "the chat has more than one username, you get the one we checked last. Otherwise it works the same way as "
+        "resolveUsername.\n\nThe responses of resolveUsername have an ETag and a Cache-Control header, which says how "
+        "long you can keep them. If you send the ETag back in If-None-Match and nothing changed, you get an empty 304. "
+        "Big responses of resolveUsernames and this document are sent with gzip, if you accept it."
+    )
+    response = web.Response(text=string)
+    # this is a few kilobytes of text, it gets a lot smaller. A cache in front of us has to keep both versions
+    response.enable_compression()
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+async def ready(
+    _: web.Request, clients: "ClientPool", cache: "UsernameCache"
+) -> web.Response:
+    # this is 200 once the clients are connected and the cache is loaded, and 503 before
+    string = (
+        f"clients: {len(clients) - len(clients.starting)}/{len(clients)} started\n"
+        f"cache: {'loading' if cache.loading else 'loaded'}, {len(cache)} entries"
+    )
+    return web.Response(
+        text=string, status=200 if clients.ready() and not cache.loading else 503
     )
-    return web.Response(text=string)
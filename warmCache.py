@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from typing import TYPE_CHECKING
+
+from telethon import TelegramClient
+
+from api_keys import api_id, api_hash
+from cacheStore import SqliteStore, JsonStore, UsernameCache
+from clientPool import ClientPool, FloodRegistry
+from main import CLIENTS, CACHE_BACKEND, session_creator
+from resolveUsername import FRESH_FOR, lookup, start_lookup, valid_username
+
+if TYPE_CHECKING:
+    from typing import Iterator, Optional, Set, TextIO, Tuple
+
+    from cacheStore import CacheStore
+    from scrapeClient import ScrapeClient
+
+# this fills the cache before the API serves anyone, so the first users don't pay for the lookups. It reads one username
+# per line, from a file or stdin, and looks each one up the same way a request would, with all clients of main.py at
+# once. Stop the API first, a session can't be opened twice:
+#
+#     python warmCache.py usernames.txt
+#
+# If it is interrupted, running it again with the same input goes on where it stopped
+
+# this is how many usernames are looked up at the same time for every client
+CONCURRENCY_PER_CLIENT = 2
+# each of them waits this many seconds after a lookup, so the warm up doesn't eat the flood budget in one go
+PAUSE = 0.5
+# the progress is written to the checkpoint file every this many seconds
+CHECKPOINT_INTERVAL = 30
+# the entries are read from the store when they are needed, this is how many of them are kept in memory
+CACHE_LIMIT = 10000
+
+
+class Checkpoint:
+    """
+    This remembers how many lines of the input are done. The lookups finish out of order, so it is the number of lines
+    before the first one which isn't done yet. The lines after that might be looked up again after an interruption,
+    but those are fresh in the cache by then and skipped.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done = 0
+        if os.path.exists(path):
+            with open(path) as infile:
+                self.done = int(infile.read())
+        # the lines which are looked up right now, and the one which comes next
+        self.running: "Set[int]" = set()
+        self.next = self.done
+
+    def started(self, index: int) -> None:
+        self.running.add(index)
+        self.next = index + 1
+
+    def finished(self, index: int) -> None:
+        self.running.discard(index)
+
+    def position(self) -> int:
+        return min(self.running) if self.running else self.next
+
+    def save(self, position: int) -> None:
+        # the file is replaced in one go, so an interruption while writing doesn't break it
+        with open(self.path + ".tmp", "w") as outfile:
+            outfile.write(str(position))
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def read_usernames(infile: "TextIO", skip: int) -> "Iterator[Tuple[int, str]]":
+    # the line number and the username of every line, the first skip lines are done already
+    for index, line in enumerate(infile):
+        if index < skip:
+            continue
+        user_name = line.strip()
+        if user_name.startswith("@"):
+            user_name = user_name[1:]
+        yield index, user_name
+
+
+async def persist(store: "CacheStore") -> None:
+    # the checkpoint may only count a username once its entry is on disk
+    if isinstance(store, SqliteStore):
+        await asyncio.get_running_loop().run_in_executor(None, store.flush)
+    else:
+        await store.compact()
+
+
+async def warm_one(
+    user_name: str,
+    clients: ClientPool,
+    cache: UsernameCache,
+    session: "ScrapeClient",
+) -> str:
+    """
+    This looks up one username like a request would, and returns what came of it. If all clients are in a flood wait,
+    it waits for the first one to be over and tries again, so no username is left out.
+    """
+    if not valid_username(user_name):
+        return "invalid"
+    known = cache.get(user_name.lower())
+    if known and time.time() - known.get("verified", 0) < FRESH_FOR:
+        return "fresh"
+    while True:
+        future = start_lookup(user_name, None, clients, cache, session, lookup)
+        # the lookup is cancelled if it runs out of time, this only waits for it to be done either way
+        await asyncio.wait((future,))
+        if future.cancelled():
+            return "timeout"
+        if future.exception():
+            logging.error(
+                "Looking up %s failed", user_name, exc_info=future.exception()
+            )
+            return "failed"
+        status, _ = future.result()
+        if status != 429:
+            return "resolved" if status == 200 else "not_found"
+        await asyncio.sleep(max(clients.retry_after(), 1))
+
+
+async def worker(
+    usernames: "Iterator[Tuple[int, str]]",
+    clients: ClientPool,
+    cache: UsernameCache,
+    session: "ScrapeClient",
+    checkpoint: Checkpoint,
+    outcomes: "Counter[str]",
+) -> None:
+    # all workers take their usernames from the same iterator, so every line is looked up once
+    for index, user_name in usernames:
+        checkpoint.started(index)
+        outcome = await warm_one(user_name, clients, cache, session)
+        checkpoint.finished(index)
+        outcomes[outcome] += 1
+        # usernames which didn't need telegram don't need a pause either
+        if outcome not in ("invalid", "fresh"):
+            await asyncio.sleep(PAUSE)
+
+
+async def save_progress(
+    store: "CacheStore", checkpoint: Checkpoint, outcomes: "Counter[str]"
+) -> None:
+    # this runs next to the workers until they are done
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        # the position is taken first, everything before it is queued for the store by then
+        position = checkpoint.position()
+        await persist(store)
+        checkpoint.save(position)
+        logging.info("%s lines done: %s", position, dict(outcomes))
+
+
+async def warm(
+    usernames: "Iterator[Tuple[int, str]]",
+    clients: ClientPool,
+    cache: UsernameCache,
+    session: "ScrapeClient",
+    checkpoint: Checkpoint,
+    concurrency: int,
+) -> "Counter[str]":
+    """
+    This looks up all usernames with the given amount of workers, and saves the progress every now and then. The
+    clients have to be started.
+    """
+    outcomes: "Counter[str]" = Counter()
+    saver = asyncio.create_task(save_progress(cache.store, checkpoint, outcomes))
+    try:
+        await asyncio.gather(
+            *(
+                worker(usernames, clients, cache, session, checkpoint, outcomes)
+                for _ in range(concurrency)
+            )
+        )
+    finally:
+        saver.cancel()
+    return outcomes
+
+
+async def run(arguments: argparse.Namespace) -> None:
+    # these are the same sessions, flood waits and cache the API uses
+    clients = ClientPool(
+        [TelegramClient("session_" + str(x), api_id, api_hash) for x in range(CLIENTS)],
+        FloodRegistry("cache.sqlite3") if CACHE_BACKEND == "sqlite" else None,
+        started=False,
+    )
+    store: "CacheStore"
+    if CACHE_BACKEND == "sqlite":
+        store = SqliteStore("cache.sqlite3")
+    else:
+        store = JsonStore("cache.json")
+    cache = UsernameCache(store, limit=CACHE_LIMIT)
+    session = await session_creator()
+    infile = sys.stdin if arguments.input == "-" else open(arguments.input)
+    checkpoint = Checkpoint(
+        arguments.checkpoint
+        or ("warmCache" if arguments.input == "-" else arguments.input) + ".checkpoint"
+    )
+    if checkpoint.done:
+        logging.info("Skipping the first %s lines, they are done", checkpoint.done)
+    outcomes: "Optional[Counter[str]]" = None
+    try:
+        await clients.start()
+        outcomes = await warm(
+            read_usernames(infile, checkpoint.done),
+            clients,
+            cache,
+            session,
+            checkpoint,
+            arguments.concurrency or CONCURRENCY_PER_CLIENT * len(clients),
+        )
+        print(
+            " ".join(
+                f"{outcome}:{count}" for outcome, count in sorted(outcomes.items())
+            )
+        )
+    finally:
+        # this runs on an interruption as well, closing the store writes everything which is still queued
+        position = checkpoint.position()
+        store.close()
+        if outcomes is None:
+            checkpoint.save(position)
+        else:
+            # the whole input is done, the next run starts from the beginning
+            checkpoint.remove()
+        infile.close()
+        await session.close()
+        for client in clients:
+            await client.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Fill the cache with the usernames from a file, one per line."
+    )
+    parser.add_argument(
+        "input", nargs="?", default="-", help="the file, or - for stdin"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="where the progress is kept, the input file with .checkpoint by default",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help=f"the usernames looked up at once, {CONCURRENCY_PER_CLIENT} per client by default",
+    )
+    arguments = parser.parse_args()
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    asyncio.run(run(arguments))
+
+
+if __name__ == "__main__":
+    main()